@@ -6,7 +6,11 @@ from flask_app_class import FlaskApp
 parser = argparse.ArgumentParser(description="Flask Class Based application framework.")
 parser.add_argument("--config", type=str, default=None, help='Enter a JSON configuration file to load.')
 parser.add_argument("--log_level", type=str, default='DEBUG', help='Enter a logging level ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")')
+parser.add_argument("--precompress", action='store_true', help='Build .gz/.br variants of the static files and exit.')
 args = parser.parse_args()
 
 app = FlaskApp(config_file=args.config, web_log_level=args.log_level, app_log_level=args.log_level)
+if args.precompress:
+    app.precompress_static()
+    sys.exit(0)
 app.start()
\ No newline at end of file
@@ -38,24 +38,32 @@ Homepage at http://github.com/btimby/py-radius/
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import sys
+import json
+import time
+import queue
 import socket
+import asyncio
 import logging
 import struct
+import threading
 
 from select import select
-from random import randint
+from random import randint, shuffle
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing, contextmanager
-
-try:
-    from collections import UserDict
-except ImportError:
-    from UserDict import UserDict
+from functools import lru_cache
+from uuid import uuid4
 
 try:
     from hashlib import md5
 except ImportError:
     from md5 import new as md5
 
+import hmac
+from time import monotonic
+
 from six import PY3
 
 
@@ -68,8 +76,10 @@ LOGGER.addHandler(logging.NullHandler())
 # -------------------------------
 PACKET_MAX = 4096
 DEFAULT_PORT = 1812
+DEFAULT_ACCT_PORT = 1813
 DEFAULT_RETRIES = 3
 DEFAULT_TIMEOUT = 5 
+DEFAULT_MIN_TIMEOUT = 0.1
 # -------------------------------
 
 # Protocol specific constants.
@@ -139,7 +149,21 @@ ATTR_LOGIN_LAT_GROUP = 36
 ATTR_FRAMED_APPLETALK_LINK = 37
 ATTR_FRAMED_APPLETALK_NETWORK = 38
 ATTR_FRAMED_APPLETALK_ZONE = 39
-# ATTR_RESERVED = 40-59
+# Accounting (RFC 2866).
+ATTR_ACCT_STATUS_TYPE = 40
+ATTR_ACCT_DELAY_TIME = 41
+ATTR_ACCT_INPUT_OCTETS = 42
+ATTR_ACCT_OUTPUT_OCTETS = 43
+ATTR_ACCT_SESSION_ID = 44
+ATTR_ACCT_AUTHENTIC = 45
+ATTR_ACCT_SESSION_TIME = 46
+ATTR_ACCT_INPUT_PACKETS = 47
+ATTR_ACCT_OUTPUT_PACKETS = 48
+ATTR_ACCT_TERMINATE_CAUSE = 49
+ATTR_ACCT_MULTI_SESSION_ID = 50
+ATTR_ACCT_LINK_COUNT = 51
+ATTR_EVENT_TIMESTAMP = 55
+# ATTR_RESERVED = 52-54, 56-59
 ATTR_CHAP_CHALLENGE = 60
 ATTR_NAS_PORT_TYPE = 61
 ATTR_PORT_LIMIT = 62
@@ -150,6 +174,7 @@ ATTR_TUNNEL_TYPE = 64
 ATTR_TUNNEL_MEDIUM_TYPE = 65
 ATTR_TUNNEL_PRIVATE_GROUP_ID = 81
 # END ADDED
+ATTR_MESSAGE_AUTHENTICATOR = 80
 
 ATTRS = {
     ATTR_USER_NAME: 'User-Name',
@@ -189,6 +214,19 @@ ATTRS = {
     ATTR_FRAMED_APPLETALK_LINK: 'Framed-AppleTalk-Link',
     ATTR_FRAMED_APPLETALK_NETWORK: 'Framed-AppleTalk-Network',
     ATTR_FRAMED_APPLETALK_ZONE: 'Framed-AppleTalk-Zone',
+    ATTR_ACCT_STATUS_TYPE: 'Acct-Status-Type',
+    ATTR_ACCT_DELAY_TIME: 'Acct-Delay-Time',
+    ATTR_ACCT_INPUT_OCTETS: 'Acct-Input-Octets',
+    ATTR_ACCT_OUTPUT_OCTETS: 'Acct-Output-Octets',
+    ATTR_ACCT_SESSION_ID: 'Acct-Session-Id',
+    ATTR_ACCT_AUTHENTIC: 'Acct-Authentic',
+    ATTR_ACCT_SESSION_TIME: 'Acct-Session-Time',
+    ATTR_ACCT_INPUT_PACKETS: 'Acct-Input-Packets',
+    ATTR_ACCT_OUTPUT_PACKETS: 'Acct-Output-Packets',
+    ATTR_ACCT_TERMINATE_CAUSE: 'Acct-Terminate-Cause',
+    ATTR_ACCT_MULTI_SESSION_ID: 'Acct-Multi-Session-Id',
+    ATTR_ACCT_LINK_COUNT: 'Acct-Link-Count',
+    ATTR_EVENT_TIMESTAMP: 'Event-Timestamp',
     ATTR_CHAP_CHALLENGE: 'CHAP-Challenge',
     ATTR_NAS_PORT_TYPE: 'NAS-Port-Type',
     ATTR_PORT_LIMIT: 'Port-Limit',
@@ -197,12 +235,40 @@ ATTRS = {
     # ADDED - tdunteman
     ATTR_TUNNEL_TYPE: 'Tunnel-Type',
     ATTR_TUNNEL_MEDIUM_TYPE: 'Tunnel-Medium-Type',
-    ATTR_TUNNEL_PRIVATE_GROUP_ID: 'Tunnel-Private-Group-ID'
+    ATTR_TUNNEL_PRIVATE_GROUP_ID: 'Tunnel-Private-Group-ID',
     # END ADDED
+    ATTR_MESSAGE_AUTHENTICATOR: 'Message-Authenticator',
 }
 
 # Map from name to id.
 ATTR_NAMES = {v.lower(): k for k, v in ATTRS.items()}
+
+# Attributes with integer values (packed as 4 octets).
+INTEGER_ATTRS = {
+    ATTR_NAS_PORT, ATTR_SERVICE_TYPE, ATTR_FRAMED_PROTOCOL, ATTR_FRAMED_MTU,
+    ATTR_SESSION_TIMEOUT, ATTR_IDLE_TIMEOUT, ATTR_NAS_PORT_TYPE,
+    ATTR_ACCT_STATUS_TYPE, ATTR_ACCT_DELAY_TIME, ATTR_ACCT_INPUT_OCTETS,
+    ATTR_ACCT_OUTPUT_OCTETS, ATTR_ACCT_AUTHENTIC, ATTR_ACCT_SESSION_TIME,
+    ATTR_ACCT_INPUT_PACKETS, ATTR_ACCT_OUTPUT_PACKETS,
+    ATTR_ACCT_TERMINATE_CAUSE, ATTR_ACCT_LINK_COUNT, ATTR_EVENT_TIMESTAMP,
+}
+
+# Acct-Status-Type values.
+ACCT_STATUS_START = 1
+ACCT_STATUS_STOP = 2
+ACCT_STATUS_INTERIM_UPDATE = 3
+
+# Acct-Terminate-Cause values (subset).
+TERMINATE_USER_REQUEST = 1
+TERMINATE_IDLE_TIMEOUT = 4
+TERMINATE_SESSION_TIMEOUT = 5
+TERMINATE_ADMIN_RESET = 6
+TERMINATE_ADMIN_REBOOT = 7
+
+# Map from code, name or lower case name to id (fast path for Attributes).
+ATTR_CODES = dict(ATTR_NAMES)
+ATTR_CODES.update({v: k for k, v in ATTRS.items()})
+ATTR_CODES.update({i: i for i in range(1, 256)})
 # -------------------------------
 
 
@@ -294,80 +360,148 @@ def authenticate(secret, username, password, host=None, port=None, **kwargs):
     return Radius(secret, **rkwargs).authenticate(username, password, **kwargs)
 
 
+@lru_cache(maxsize=32)
+def _secret_md5(secret):
+    """
+    MD5 state after hashing the shared secret. Copy it and update with the
+    per packet data instead of hashing the secret every time.
+    """
+    return md5(secret)
+
+
 def radcrypt(secret, authenticator, password):
     """Encrypt a password with the secret and authenticator."""
     # First, pad the password to multiple of 16 octets.
-    password += b'\0' * (16 - (len(password) % 16))
+    length = max(len(password) + (-len(password) % 16), 16)
 
-    if len(password) > 128:
+    if length > 128:
         raise ValueError('Password exceeds maximun of 128 bytes')
 
-    result, last = b'', authenticator
-    while password:
+    password = password.ljust(length, b'\0')
+    prefix = _secret_md5(secret)
+    result, last = bytearray(length), authenticator
+    for pos in range(0, length, 16):
         # md5sum the shared secret with the authenticator,
         # after the first iteration, the authenticator is the previous
-        # result of our encryption.
-        hash = md5(secret + last).digest()
-        for i in range(16):
-            result += chr(ord(hash[i]) ^ ord(password[i]))
-        # The next iteration will act upon the next 16 octets of the password
-        # and the result of our xor operation above. We will set last to
-        # the last 16 octets of our result (the xor we just completed). And
-        # remove the first 16 octets from the password.
-        last, password = result[-16:], password[16:]
+        # result of our encryption. XOR a whole 16 octet block at a time.
+        hash = prefix.copy()
+        hash.update(last)
+        last = (int.from_bytes(hash.digest(), 'big') ^
+                int.from_bytes(password[pos:pos + 16], 'big')).to_bytes(16, 'big')
+        result[pos:pos + 16] = last
+
+    return bytes(result)
 
+
+def vendor_attributes(value):
+    """
+    Split a Vendor-Specific attribute value (RFC 2865 5.26) into a list of
+    (vendor id, vendor type, data) sub-attributes. Values that do not use
+    the recommended sub-attribute format are returned as a single
+    (vendor id, None, data) entry.
+    """
+    if len(value) < 4:
+        return []
+    vendor_id = int.from_bytes(value[:4], 'big')
+    result, pos = [], 4
+    while pos + 2 <= len(value):
+        vendor_type, l = value[pos], value[pos + 1]
+        if l < 2 or pos + l > len(value):
+            return [(vendor_id, None, value[4:])]
+        result.append((vendor_id, vendor_type, value[pos + 2:pos + l]))
+        pos += l
+    if pos != len(value):
+        return [(vendor_id, None, value[4:])]
     return result
 
 
-class Attributes(UserDict):
+class Attributes(object):
     """
     Dictionary-style interface.
 
     Can retrieve or set values by name or by code. Internally stores items by
-    their assigned code. A given attribute can be present more than once.
+    their assigned code. A given attribute can be present more than once, so
+    each code holds a list of values.
     """
-    def __init__(self, initialdata={}):
-        UserDict.__init__(self, {})
-        # Set keys via update() to invoke validation.
-        self.update(initialdata)
+    __slots__ = ('_data',)
 
-    def __getkeys(self, value):
-        """Return tuple of code, name for given code or name."""
-        if isinstance(value, int):
-            return value, ATTRS[value]
-        else:
-            id = ATTR_NAMES[value.lower()]
-            return id, ATTRS[id]
+    def __init__(self, initialdata=None):
+        self._data = {}
+        if initialdata:
+            # Set keys via update() to invoke validation.
+            self.update(initialdata)
+
+    @staticmethod
+    def _code(key):
+        """Return the code for a given code or name."""
+        code = ATTR_CODES.get(key, None)
+        if code is None:
+            code = ATTR_NAMES[key.lower()]
+        return code
 
     def __contains__(self, key):
         """
         Override in operator.
         """
-        code = self.__getkeys(key)[0]
-        return UserDict.__contains__(self, code)
+        try:
+            return self._code(key) in self._data
+        except (KeyError, AttributeError):
+            return False
 
     def __getitem__(self, key):
         """
         Retrieve an item from attributes (by name or id).
         """
-        for k in self.__getkeys(key):
-            try:
-                return UserDict.__getitem__(self, k)
-            except KeyError:
-                continue
-        raise KeyError(key)
+        try:
+            return self._data[self._code(key)]
+        except (KeyError, AttributeError):
+            raise KeyError(key)
 
     def __setitem__(self, key, value):
         """
         Add an item to attributes (by name or id)
         """
         try:
-            code, name = self.__getkeys(key)
-        except KeyError:
+            code = self._code(key)
+        except (KeyError, AttributeError):
             raise ValueError('Invalid radius attribute: %s' % key)
-        values = self.get(code, [])
-        values.append(value)
-        UserDict.__setitem__(self, code, values)
+        values = self._data.get(code, None)
+        if values is None:
+            self._data[code] = [value]
+        else:
+            values.append(value)
+
+    def __delitem__(self, key):
+        del self._data[self._code(key)]
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, Attributes):
+            return self._data == other._data
+        return NotImplemented
+
+    def __repr__(self):
+        return 'Attributes(%r)' % dict(self.nameditems())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
 
     def update(self, data):
         """
@@ -380,31 +514,57 @@ class Attributes(UserDict):
         """
         Yields name value pairs as names (instead of ids).
         """
-        for k, v in self.items():
-            yield self.__getkeys(k)[1], v
+        for k, v in self._data.items():
+            yield ATTRS.get(k, 'Attr-%s' % k), v
+
+    def size(self):
+        """Packed length of the attributes in octets."""
+        return sum(len(value) + 2 for values in self._data.values()
+                   for value in values)
+
+    def pack_into(self, buffer, offset=0):
+        """
+        Packs the attributes into a writable buffer at offset. Returns the
+        offset after the last attribute.
+        """
+        for code, values in self._data.items():
+            for value in values:
+                value = bytes_safe(value)
+                struct.pack_into('BB', buffer, offset, code, len(value) + 2)
+                buffer[offset + 2:offset + 2 + len(value)] = value
+                offset += len(value) + 2
+        return offset
 
     def pack(self):
         """
         Packs Attributes instance into data buffer.
         """
-        data = []
-        for key, values in self.items():
-            for value in values:
-                data.append(struct.pack('BB%ds' % len(value), key,
-                                        len(value) + 2, bytes_safe(value)))
-        return join(data)
+        buffer = bytearray(self.size())
+        self.pack_into(buffer)
+        return bytes(buffer)
 
     @staticmethod
     def unpack(data):
         """
-        Unpacks data into Attributes instance.
+        Unpacks data into Attributes instance. Repeated attributes are
+        kept in the order received.
         """
-        pos, attrs = 0, {}
-        while pos < len(data):
-            code, l = struct.unpack('BB', data[pos:pos + 2])
-            attrs[code] = data[pos + 2:pos + l]
+        data = memoryview(data)
+        attrs = Attributes()
+        store = attrs._data
+        pos, end = 0, len(data)
+        while pos + 2 <= end:
+            code, l = data[pos], data[pos + 1]
+            if l < 2:
+                LOGGER.warning('Invalid attribute length %s', l)
+                break
+            value = data[pos + 2:pos + l].tobytes()
+            if code in store:
+                store[code].append(value)
+            else:
+                store[code] = [value]
             pos += l
-        return Attributes(attrs)
+        return attrs
 
 
 class Message(object):
@@ -437,7 +597,7 @@ class Message(object):
                  attributes=None):
         self.code = code
         self.secret = secret
-        self.id = id if id else randint(0, 255)
+        self.id = id if id is not None else randint(0, 255)
         self.authenticator = authenticator if authenticator else os.urandom(16)
         if isinstance(attributes, dict):
             attributes = Attributes(attributes)
@@ -445,23 +605,50 @@ class Message(object):
 
     def pack(self):
         """Pack the packet into binary form for transport."""
-        # First pack the attributes, since we need to know their length.
-        attrs = self.attributes.pack()
-        data = []
-        # Now pack the code, id, total length, authenticator
-        data.append(struct.pack('!BBH16s', self.code, self.id,
-                    len(attrs) + 20, self.authenticator))
+        # Size the buffer from the attributes, then pack the code, id,
+        # total length, authenticator and the attributes in place.
+        length = self.attributes.size() + 20
+        data = bytearray(length)
+        struct.pack_into('!BBH16s', data, 0, self.code, self.id, length,
+                         self.authenticator)
         # Attributes take up the remainder of the message.
-        data.append(attrs)
-        return join(data)
+        self.attributes.pack_into(data, 20)
+        if self.code == CODE_ACCOUNTING_REQUEST:
+            # Request Authenticator (RFC 2866 3): MD5 of the packet with a
+            # zero authenticator followed by the secret.
+            data[4:20] = bytes(16)
+            signature = md5(data)
+            signature.update(self.secret)
+            self.authenticator = signature.digest()
+            data[4:20] = self.authenticator
+        if ATTR_MESSAGE_AUTHENTICATOR in self.attributes:
+            self._sign(data)
+        return bytes(data)
+
+    def _sign(self, data):
+        """
+        Fill in the Message-Authenticator attribute (RFC 3579), an HMAC-MD5
+        of the packet with the attribute zeroed. data is a bytearray and is
+        signed in place.
+        """
+        pos = 20
+        while pos < len(data):
+            code, l = data[pos], data[pos + 1]
+            if code == ATTR_MESSAGE_AUTHENTICATOR:
+                data[pos + 2:pos + 18] = bytes(16)
+                data[pos + 2:pos + 18] = hmac.new(self.secret, data,
+                                                  md5).digest()
+                break
+            pos += l
+        return data
 
     @staticmethod
     def unpack(secret, data):
         """Unpack the data into it's fields."""
-        code, id, l, authenticator = struct.unpack('!BBH16s', data[:20])
+        code, id, l, authenticator = struct.unpack_from('!BBH16s', data)
         if l != len(data):
             LOGGER.warning('Too much data!')
-        attrs = Attributes.unpack(data[20:l])
+        attrs = Attributes.unpack(memoryview(data)[20:l])
         return Message(secret, code, id, authenticator, attrs)
 
     def verify(self, data):
@@ -471,26 +658,315 @@ class Message(object):
         Ensures that a message is a valid response to this message, then
         unpacks it.
         """
-        id = ord(data[1])
+        id = data[1]
         assert self.id == id, 'ID mismatch (%s != %s)' % (self.id, id)
-        signature = md5(
-            data[:4] + self.authenticator + data[20:] + self.secret).digest()
-        assert signature == data[4:20], 'Invalid authenticator'
+        view = memoryview(data)
+        signature = md5(view[:4])
+        signature.update(self.authenticator)
+        signature.update(view[20:])
+        signature.update(self.secret)
+        assert signature.digest() == data[4:20], 'Invalid authenticator'
         return Message.unpack(self.secret, data)
 
 
+class RttEstimator(object):
+    """
+    Smoothed round trip time estimate for a server (RFC 6298 / Jacobson).
+
+    The retransmission timeout starts at max_timeout and follows
+    srtt + 4 * rttvar once replies are measured, bounded by min_timeout and
+    max_timeout. Only replies to requests that were not retransmitted are
+    sampled (Karn's algorithm). Each retransmission of a request doubles the
+    timeout.
+    """
+
+    def __init__(self, min_timeout=DEFAULT_MIN_TIMEOUT,
+                 max_timeout=DEFAULT_TIMEOUT):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = None
+        self._lock = threading.Lock()
+
+    @property
+    def rto(self):
+        """Current retransmission timeout in seconds."""
+        if self.srtt is None:
+            return self.max_timeout
+        return min(max(self.srtt + 4 * self.rttvar, self.min_timeout),
+                   self.max_timeout)
+
+    def sample(self, rtt):
+        """Update the estimate with a measured round trip time."""
+        with self._lock:
+            if self.srtt is None:
+                self.srtt, self.rttvar = rtt, rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def timeouts(self, retries):
+        """Yield the timeout for each attempt with exponential backoff."""
+        rto = self.rto
+        for i in range(retries):
+            yield min(rto * (2 ** i), self.max_timeout)
+
+
+def attempt_timeouts(retries, timeout, estimator=None, deadline=None):
+    """
+    Yield the wait time for each attempt of a request. Fixed timeout, or
+    adaptive if an RttEstimator is given. If deadline (seconds) is set the
+    attempts stop once it has passed and the last wait is cut short.
+    """
+    schedule = estimator.timeouts(retries) if estimator is not None \
+        else (timeout for i in range(retries))
+    end = monotonic() + deadline if deadline is not None else None
+    for wait in schedule:
+        if end is not None:
+            remaining = end - monotonic()
+            if remaining <= 0:
+                return
+            wait = min(wait, remaining)
+        yield wait
+
+
+class _PendingRequest(object):
+    """
+    An outstanding request on a RadiusTransport waiting for its reply.
+    """
+    __slots__ = ('message', 'event', 'reply', 'error')
+
+    def __init__(self, message):
+        self.message = message
+        self.event = threading.Event()
+        self.reply = None
+        self.error = None
+
+
+class RadiusTransport(object):
+    """
+    Long lived UDP socket to a single radius server.
+
+    Up to 256 requests can be outstanding at once, each using a unique
+    packet Identifier. A background reader thread routes replies to the
+    waiting request by Identifier. Identifiers are reused in FIFO order
+    so a late reply to an old request is unlikely to meet a new request
+    with the same Identifier (and would fail verification if it did).
+
+    Use get_transport() to share one transport per server.
+    """
+
+    def __init__(self, host, port=DEFAULT_PORT):
+        self._host = host
+        self._port = port
+        self._lock = threading.Lock()
+        self._id_available = threading.Condition(self._lock)
+        ids = list(range(256))
+        shuffle(ids)
+        self._free_ids = deque(ids)
+        self._pending = {}
+        self._sock = None
+        self._reader = None
+        self._pid = None
+        self._closed = False
+
+    @property
+    def host(self):
+        return self._host
+
+    @property
+    def port(self):
+        return self._port
+
+    @property
+    def outstanding(self):
+        """Number of requests currently waiting for a reply."""
+        return len(self._pending)
+
+    def send(self, message, retries=DEFAULT_RETRIES, timeout=DEFAULT_TIMEOUT,
+             estimator=None, deadline=None):
+        """
+        Send a message and wait for the verified reply.
+
+        The message Identifier is assigned by the transport. The same
+        packet is retransmitted after each timeout, up to retries times
+        (see attempt_timeouts for estimator and deadline). Raises NoResponse
+        if no valid reply is received.
+        """
+        pending = _PendingRequest(message)
+        self._acquire_id(pending, deadline if deadline is not None
+                         else retries * timeout)
+        i = 0
+        try:
+            send = message.pack()
+            for i, wait in enumerate(attempt_timeouts(retries, timeout,
+                                                      estimator, deadline)):
+                LOGGER.debug('Sending id %s to %s:%s (try %s)', message.id,
+                             self.host, self.port, i)
+                start = monotonic()
+                try:
+                    self._socket().send(send)
+                except socket.error as e:
+                    LOGGER.debug('Socket error', exc_info=True)
+                    raise SocketError(e)
+                if pending.event.wait(wait):
+                    if pending.error is not None:
+                        raise SocketError(pending.error)
+                    if i == 0 and estimator is not None:
+                        estimator.sample(monotonic() - start)
+                    return pending.reply
+                LOGGER.warning('Timeout expired on try %s', i)
+        finally:
+            self._release_id(message.id)
+
+        LOGGER.error('Request timed out after %s tries', i + 1)
+        raise NoResponse()
+
+    def close(self):
+        """Close the socket and stop the reader thread."""
+        with self._lock:
+            self._closed = True
+            sock, self._sock = self._sock, None
+        if sock is not None:
+            sock.close()
+
+    def _acquire_id(self, pending, timeout):
+        """Reserve a free Identifier for the request."""
+        with self._id_available:
+            if not self._id_available.wait_for(lambda: self._free_ids, timeout):
+                LOGGER.error('No free identifiers for %s:%s', self.host, self.port)
+                raise NoResponse()
+            pending.message.id = self._free_ids.popleft()
+            self._pending[pending.message.id] = pending
+
+    def _fail_pending(self, error):
+        """Wake every waiting request with an error instead of a reply."""
+        with self._lock:
+            pending = list(self._pending.values())
+        for request in pending:
+            if not request.event.is_set():
+                request.error = error
+                request.event.set()
+
+    def _release_id(self, id):
+        """Return an Identifier to the free pool."""
+        with self._id_available:
+            if self._pending.pop(id, None) is not None:
+                self._free_ids.append(id)
+                self._id_available.notify()
+
+    def _socket(self):
+        """Return the connected socket, creating it (and the reader) if needed."""
+        with self._lock:
+            if self._sock is None or self._pid != os.getpid():
+                # (re)create after close or in a forked worker process
+                self._closed = False
+                self._pid = os.getpid()
+                self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self._sock.connect((self.host, self.port))
+                self._sock.settimeout(1.0)
+                LOGGER.debug('Connected to %s:%s', self.host, self.port)
+                self._reader = threading.Thread(
+                    target=self._read, args=(self._sock,),
+                    name='RadiusTransport-%s:%s' % (self.host, self.port),
+                    daemon=True)
+                self._reader.start()
+            return self._sock
+
+    def _read(self, sock):
+        """Reader thread. Routes each reply to the request with the same id."""
+        while not self._closed and sock is self._sock:
+            try:
+                recv = sock.recv(PACKET_MAX)
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                if self._closed or sock is not self._sock:
+                    break
+                LOGGER.warning('Receive error from %s:%s: %s', self.host,
+                               self.port, e)
+                if isinstance(e, ConnectionRefusedError):
+                    # ICMP port unreachable, nothing is listening. Fail the
+                    # waiting requests now rather than after their timeouts
+                    self._fail_pending(e)
+                continue
+            if len(recv) < 20:
+                continue
+            pending = self._pending.get(recv[1], None)
+            if pending is None or pending.event.is_set():
+                LOGGER.debug('Discarding reply with unknown id %s', recv[1])
+                continue
+            try:
+                pending.reply = pending.message.verify(recv)
+            except AssertionError as e:
+                LOGGER.warning('Invalid response discarded %s', e)
+                continue
+            pending.event.set()
+
+
+class _RadiusDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    asyncio protocol for a single request. Resolves future with the first
+    valid reply.
+    """
+
+    def __init__(self, message, future):
+        self.message = message
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        if self.future.done():
+            return
+        try:
+            self.future.set_result(self.message.verify(data))
+        except AssertionError as e:
+            LOGGER.warning('Invalid response discarded %s', e)
+
+    def error_received(self, exc):
+        LOGGER.warning('Receive error: %s', exc)
+        if isinstance(exc, ConnectionRefusedError) and not self.future.done():
+            # ICMP port unreachable, fail now rather than after the timeout
+            self.future.set_exception(SocketError(exc))
+
+
+_TRANSPORTS = {}
+_TRANSPORTS_LOCK = threading.Lock()
+
+
+def get_transport(host, port=DEFAULT_PORT):
+    """Return the shared RadiusTransport for a server."""
+    with _TRANSPORTS_LOCK:
+        if (host, port) not in _TRANSPORTS:
+            _TRANSPORTS[(host, port)] = RadiusTransport(host, port)
+        return _TRANSPORTS[(host, port)]
+
+
 class Radius(object):
     """
     Radius client implementation.
+
+    With persistent=True requests are sent over the shared RadiusTransport
+    for the server instead of a new socket for each request.
+
+    With adaptive=True the retransmission timeout follows the measured
+    round trip time of the server (see RttEstimator), with timeout as the
+    upper bound. deadline (seconds) limits the total time of a request
+    including retransmissions.
     """
 
     def __init__(self, secret, host='radius', port=DEFAULT_PORT,
-                 retries=DEFAULT_RETRIES, timeout=DEFAULT_TIMEOUT):
+                 retries=DEFAULT_RETRIES, timeout=DEFAULT_TIMEOUT,
+                 persistent=False, adaptive=False,
+                 min_timeout=DEFAULT_MIN_TIMEOUT, deadline=None):
         self._secret = bytes_safe(secret)
         self.retries = retries
         self.timeout = timeout
+        self.deadline = deadline
         self._host = host
         self._port = port
+        self._transport = get_transport(host, port) if persistent else None
+        self.estimator = RttEstimator(min_timeout, timeout) if adaptive \
+            else None
 
     @property
     def host(self):
@@ -512,28 +988,36 @@ class Radius(object):
             yield c
 
     def send_message(self, message):
+        if self._transport is not None:
+            return self._transport.send(message, self.retries, self.timeout,
+                                        self.estimator, self.deadline)
+
         send = message.pack()
 
+        i = 0
         try:
             with self.connect() as c:
-                for i in range(self.retries):
-                    LOGGER.debug(
-                        'Sending (as hex): %s',
-                        ':'.join(format(ord(c), '02x') for c in send))
+                for i, wait in enumerate(attempt_timeouts(
+                        self.retries, self.timeout, self.estimator,
+                        self.deadline)):
+                    if LOGGER.isEnabledFor(logging.DEBUG):
+                        LOGGER.debug('Sending (as hex): %s', send.hex(':'))
 
+                    start = monotonic()
                     c.send(send)
 
-                    r, w, x = select([c], [], [], self.timeout)
+                    r, w, x = select([c], [], [], wait)
                     if c in r:
                         recv = c.recv(PACKET_MAX)
+                        if i == 0 and self.estimator is not None:
+                            self.estimator.sample(monotonic() - start)
                     else:
                         # No data available on our socket. Try again.
                         LOGGER.warning('Timeout expired on try %s', i)
                         continue
 
-                    LOGGER.debug(
-                        'Received (as hex): %s',
-                        ':'.join(format(ord(c), '02x') for c in recv))
+                    if LOGGER.isEnabledFor(logging.DEBUG):
+                        LOGGER.debug('Received (as hex): %s', recv.hex(':'))
 
                     try:
                         return message.verify(recv)
@@ -549,6 +1033,42 @@ class Radius(object):
         LOGGER.error('Request timed out after %s tries', i)
         raise NoResponse()
 
+    async def send_message_async(self, message):
+        """
+        asyncio version of send_message. Never blocks the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: _RadiusDatagramProtocol(message, future),
+                remote_addr=(self.host, self.port))
+        except OSError as e:
+            LOGGER.debug('Socket error', exc_info=True)
+            raise SocketError(e)
+
+        send = message.pack()
+        try:
+            for i, wait in enumerate(attempt_timeouts(
+                    self.retries, self.timeout, self.estimator,
+                    self.deadline)):
+                start = monotonic()
+                transport.sendto(send)
+                try:
+                    reply = await asyncio.wait_for(asyncio.shield(future),
+                                                   wait)
+                except asyncio.TimeoutError:
+                    LOGGER.warning('Timeout expired on try %s', i)
+                    continue
+                if i == 0 and self.estimator is not None:
+                    self.estimator.sample(monotonic() - start)
+                return reply
+        finally:
+            transport.close()
+
+        LOGGER.error('Request timed out after %s tries', self.retries)
+        raise NoResponse()
+
     def access_request_message(self, username, password, **kwargs):
         username = bytes_safe(username)
         password = bytes_safe(password)
@@ -569,12 +1089,67 @@ class Radius(object):
            Raises a NoResponse (or its subclass SocketError) exception if no
                responses or no valid responses are received
         """
-        reply = self.send_message(
-            self.access_request_message(username, password, **kwargs))
+        return self.authenticate_attributes(username, password,
+                                            **kwargs) is not None
+
+    async def authenticate_async(self, username, password, **kwargs):
+        """
+        asyncio version of authenticate. Same return values and exceptions.
+        """
+        return await self.authenticate_attributes_async(
+            username, password, **kwargs) is not None
 
+    def authenticate_cooperative(self, username, password, **kwargs):
+        """
+        Version of authenticate that is safe to call from a gevent greenlet.
+        See cooperative().
+        """
+        return cooperative(self.authenticate, username, password, **kwargs)
+
+    def authenticate_attributes(self, username, password, **kwargs):
+        """
+        Same as authenticate, but returns the Access-Accept reply Attributes
+        (Class, Filter-Id, Vendor-Specific, ...) on success and None on
+        failure.
+        """
+        return self._access_reply(self.send_message(
+            self.access_request_message(username, password, **kwargs)))
+
+    async def authenticate_attributes_async(self, username, password,
+                                            **kwargs):
+        """
+        asyncio version of authenticate_attributes.
+        """
+        return self._access_reply(await self.send_message_async(
+            self.access_request_message(username, password, **kwargs)))
+
+    def authenticate_attributes_cooperative(self, username, password,
+                                            **kwargs):
+        """
+        Version of authenticate_attributes that is safe to call from a gevent
+        greenlet. See cooperative().
+        """
+        return cooperative(self.authenticate_attributes, username, password,
+                           **kwargs)
+
+    def status_server(self):
+        """
+        Send a Status-Server (RFC 5997) request. Returns True if the server
+        replied. Raises NoResponse (or SocketError) if not.
+        """
+        message = Message(self.secret, CODE_STATUS_SERVER)
+        message.attributes['Message-Authenticator'] = b'\0' * 16
+        self.send_message(message)
+        return True
+
+    def _access_reply(self, reply):
+        """
+        Return the reply Attributes for Access-Accept, None for
+        Access-Reject. Raises ChallengeResponse for Access-Challenge.
+        """
         if reply.code == CODE_ACCESS_ACCEPT:
             LOGGER.info('Access accepted')
-            return True
+            return reply.attributes
 
         elif reply.code == CODE_ACCESS_CHALLENGE:
             LOGGER.info('Access challenged')
@@ -583,7 +1158,671 @@ class Radius(object):
             raise ChallengeResponse(messages, state)
 
         LOGGER.info('Access rejected')
-        return False
+        return None
+
+
+ROUND_ROBIN = 'round_robin'
+LEAST_OUTSTANDING = 'least_outstanding'
+DEFAULT_MAX_FAILURES = 3
+DEFAULT_EJECT_TIME = 30
+DEFAULT_PROBE_INTERVAL = 10
+
+
+class PoolServer(object):
+    """
+    Health state of a single server in a RadiusPool.
+    """
+
+    def __init__(self, radius):
+        self.radius = radius
+        self.outstanding = 0
+        self.failures = 0
+        self.latency = None
+        self.ejected_until = 0
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def ejected(self):
+        return self.ejected_until > monotonic()
+
+    def success(self, latency):
+        """Record a reply and its latency (exponentially weighted)."""
+        self.failures = 0
+        self.ejected_until = 0
+        self.latency = latency if self.latency is None else \
+            self.latency * 0.8 + latency * 0.2
+
+    def failure(self, max_failures, eject_time):
+        """Record a failed request, ejecting the server after max_failures."""
+        self.failures += 1
+        self.errors += 1
+        if self.failures >= max_failures and not self.ejected:
+            LOGGER.warning('Ejecting %s:%s after %s failures for %ss',
+                           self.radius.host, self.radius.port, self.failures,
+                           eject_time)
+            self.ejected_until = monotonic() + eject_time
+
+    def stats(self):
+        return {'host': self.radius.host, 'port': self.radius.port,
+                'outstanding': self.outstanding, 'failures': self.failures,
+                'latency': self.latency, 'ejected': self.ejected,
+                'requests': self.requests, 'errors': self.errors}
+
+
+class RadiusPool(object):
+    """
+    Group of radius servers with health tracking and failover.
+
+    Servers are picked round robin or by least outstanding requests (then
+    lowest latency). A server that fails max_failures requests in a row is
+    ejected for eject_time seconds. Ejected servers are probed with
+    Status-Server every probe_interval seconds and return to the pool as
+    soon as they answer.
+
+    Each server is tried once per round. A request that times out fails
+    over to the next healthy server straight away instead of retrying the
+    same server, for up to retries rounds or until deadline (seconds) has
+    passed.
+    """
+
+    def __init__(self, servers, retries=DEFAULT_RETRIES,
+                 balance=ROUND_ROBIN, max_failures=DEFAULT_MAX_FAILURES,
+                 eject_time=DEFAULT_EJECT_TIME,
+                 probe_interval=DEFAULT_PROBE_INTERVAL, deadline=None):
+        if balance not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+            raise ValueError('Invalid balance method: %s' % balance)
+        self.servers = [PoolServer(radius) for radius in servers]
+        self.retries = retries
+        self.balance = balance
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.probe_interval = probe_interval
+        self.deadline = deadline
+        self._next = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._prober = None
+        if probe_interval:
+            self._prober = threading.Thread(target=self._probe,
+                                            name='RadiusPoolProbe',
+                                            daemon=True)
+            self._prober.start()
+
+    def stats(self):
+        """Return the health state of each server."""
+        return [server.stats() for server in self.servers]
+
+    def close(self):
+        """Stop the probe thread."""
+        self._stop.set()
+
+    def candidates(self):
+        """
+        Return the servers in the order they should be tried. Ejected
+        servers are only used if every server is ejected.
+        """
+        with self._lock:
+            healthy = [x for x in self.servers if not x.ejected]
+            if not healthy:
+                return sorted(self.servers, key=lambda x: x.ejected_until)
+            if self.balance == LEAST_OUTSTANDING:
+                return sorted(healthy, key=lambda x: (
+                    x.outstanding, x.latency if x.latency is not None else 0))
+            self._next = (self._next + 1) % len(healthy)
+            return healthy[self._next:] + healthy[:self._next]
+
+    def authenticate(self, username, password, **kwargs):
+        """
+        Authenticate against the first server that answers. Same return
+        values and exceptions as Radius.authenticate.
+        """
+        return self.authenticate_attributes(username, password,
+                                            **kwargs) is not None
+
+    async def authenticate_async(self, username, password, **kwargs):
+        """
+        asyncio version of authenticate.
+        """
+        return await self.authenticate_attributes_async(
+            username, password, **kwargs) is not None
+
+    def authenticate_cooperative(self, username, password, **kwargs):
+        """
+        Version of authenticate that is safe to call from a gevent greenlet.
+        See cooperative().
+        """
+        return cooperative(self.authenticate, username, password, **kwargs)
+
+    def authenticate_attributes(self, username, password, **kwargs):
+        """
+        Authenticate against the first server that answers. Same return
+        values and exceptions as Radius.authenticate_attributes.
+        """
+        end = monotonic() + self.deadline if self.deadline is not None \
+            else None
+        for i in range(self.retries):
+            for server in self.candidates():
+                if end is not None and monotonic() >= end:
+                    raise NoResponse()
+                start = self._start(server)
+                try:
+                    result = server.radius.authenticate_attributes(
+                        username, password, **kwargs)
+                except ChallengeResponse:
+                    self._finish(server, start, True)
+                    raise
+                except NoResponse:
+                    self._finish(server, start, False)
+                    LOGGER.warning('No response from %s:%s, failing over',
+                                   server.radius.host, server.radius.port)
+                    continue
+                self._finish(server, start, True)
+                return result
+
+        LOGGER.error('No response from any server after %s rounds',
+                     self.retries)
+        raise NoResponse()
+
+    async def authenticate_attributes_async(self, username, password,
+                                            **kwargs):
+        """
+        asyncio version of authenticate_attributes.
+        """
+        end = monotonic() + self.deadline if self.deadline is not None \
+            else None
+        for i in range(self.retries):
+            for server in self.candidates():
+                if end is not None and monotonic() >= end:
+                    raise NoResponse()
+                start = self._start(server)
+                try:
+                    result = await server.radius.authenticate_attributes_async(
+                        username, password, **kwargs)
+                except ChallengeResponse:
+                    self._finish(server, start, True)
+                    raise
+                except NoResponse:
+                    self._finish(server, start, False)
+                    continue
+                self._finish(server, start, True)
+                return result
+
+        raise NoResponse()
+
+    def authenticate_attributes_cooperative(self, username, password,
+                                            **kwargs):
+        """
+        Version of authenticate_attributes that is safe to call from a gevent
+        greenlet. See cooperative().
+        """
+        return cooperative(self.authenticate_attributes, username, password,
+                           **kwargs)
+
+    def _start(self, server):
+        with self._lock:
+            server.outstanding += 1
+            server.requests += 1
+        return monotonic()
+
+    def _finish(self, server, start, ok):
+        with self._lock:
+            server.outstanding -= 1
+            if ok:
+                server.success(monotonic() - start)
+            else:
+                server.failure(self.max_failures, self.eject_time)
+
+    def _probe(self):
+        """Probe thread. Sends Status-Server to ejected servers."""
+        while not self._stop.wait(self.probe_interval):
+            for server in [x for x in self.servers if x.ejected]:
+                start = monotonic()
+                try:
+                    server.radius.status_server()
+                except NoResponse:
+                    LOGGER.debug('Status-Server probe to %s:%s failed',
+                                 server.radius.host, server.radius.port)
+                    continue
+                LOGGER.info('%s:%s answered Status-Server, returning to pool',
+                            server.radius.host, server.radius.port)
+                with self._lock:
+                    server.success(monotonic() - start)
+
+
+DEFAULT_ACCT_QUEUE_SIZE = 4096
+DEFAULT_ACCT_BATCH_SIZE = 16
+DEFAULT_ACCT_RETRY_INTERVAL = 30
+DEFAULT_ACCT_INTERIM_INTERVAL = 600
+DEFAULT_ACCT_SESSION_TIMEOUT = 43200
+ACCT_CHECK_INTERVAL = 5
+
+
+class RadiusAccounting(object):
+    """
+    Accounting (RFC 2866) for web sessions.
+
+    start(), interim() and stop() only queue a record and return straight
+    away. A background thread sends the queued records (up to batch_size
+    at once over the shared transport), retransmits them and verifies the
+    Accounting-Response. Interim-Update records are sent every
+    interim_interval seconds for open sessions, and sessions still open
+    after session_timeout seconds are stopped.
+
+    If the server does not answer, records are appended to spill_file (JSON
+    lines) and resent once retry_interval has passed. Without a spill file
+    they are dropped. Records that do not fit in the queue (queue_size) are
+    spilled or dropped the same way. See stats() for the counters.
+    """
+
+    def __init__(self, secret, host='radius', port=DEFAULT_ACCT_PORT,
+                 retries=DEFAULT_RETRIES, timeout=DEFAULT_TIMEOUT,
+                 queue_size=DEFAULT_ACCT_QUEUE_SIZE,
+                 batch_size=DEFAULT_ACCT_BATCH_SIZE, spill_file=None,
+                 retry_interval=DEFAULT_ACCT_RETRY_INTERVAL,
+                 interim_interval=DEFAULT_ACCT_INTERIM_INTERVAL,
+                 session_timeout=DEFAULT_ACCT_SESSION_TIMEOUT,
+                 nas_identifier=None, persistent=True):
+        self.radius = Radius(secret, host=host, port=port, retries=retries,
+                             timeout=timeout, persistent=persistent,
+                             adaptive=True)
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.spill_file = spill_file
+        self.retry_interval = retry_interval
+        self.interim_interval = interim_interval
+        self.session_timeout = session_timeout
+        self.nas_identifier = nas_identifier
+        self.sessions = {}  # session id -> [username, start time, last update]
+        self.counters = {'sent': 0, 'dropped': 0, 'spilled': 0,
+                         'invalid': 0}
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._retry_at = 0
+        self._spill_pending = self._count_spilled()
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(
+            max_workers=batch_size, thread_name_prefix='RadiusAccounting')
+        self._sender = threading.Thread(target=self._run,
+                                        name='RadiusAccounting', daemon=True)
+        self._sender.start()
+
+    @property
+    def host(self):
+        return self.radius.host
+
+    @property
+    def port(self):
+        return self.radius.port
+
+    @property
+    def reachable(self):
+        """False while waiting for retry_interval after a failed send."""
+        return self._retry_at <= monotonic()
+
+    def stats(self):
+        """Return the queue depth, open sessions and record counters."""
+        with self._lock:
+            return dict(self.counters, queued=self._queue.qsize(),
+                        queue_size=self.queue_size,
+                        sessions=len(self.sessions),
+                        spill_pending=self._spill_pending,
+                        reachable=self.reachable)
+
+    def start(self, username, session_id=None, **attributes):
+        """
+        Open a session and queue an Accounting Start record. Extra
+        attributes are given by name with _ for - (i.e. Framed_IP_Address).
+        Returns the session id.
+        """
+        attributes = _attribute_names(attributes)
+        session_id = session_id if session_id is not None else uuid4().hex
+        now = time.time()
+        with self._lock:
+            self.sessions[session_id] = [username, now, monotonic()]
+        self._record(ACCT_STATUS_START, username, session_id, now,
+                     attributes)
+        return session_id
+
+    def interim(self, session_id, **attributes):
+        """Queue an Interim-Update record for an open session."""
+        attributes = _attribute_names(attributes)
+        with self._lock:
+            session = self.sessions.get(session_id, None)
+            if session is None:
+                return False
+            session[2] = monotonic()
+        self._record(ACCT_STATUS_INTERIM_UPDATE, session[0], session_id,
+                     session[1], attributes)
+        return True
+
+    def stop(self, session_id, terminate_cause=TERMINATE_USER_REQUEST,
+             username=None, started=None, **attributes):
+        """
+        Close a session and queue an Accounting Stop record. A session
+        opened by another process can be stopped by giving its username
+        and start time.
+        """
+        attributes = _attribute_names(attributes)
+        with self._lock:
+            session = self.sessions.pop(session_id, None)
+        if session is None:
+            if username is None or started is None:
+                return False
+            session = [username, started, None]
+        attributes['Acct-Terminate-Cause'] = terminate_cause
+        self._record(ACCT_STATUS_STOP, session[0], session_id, session[1],
+                     attributes)
+        return True
+
+    def user_sessions(self, username):
+        """Return the ids of the open sessions of a user."""
+        with self._lock:
+            return [session_id for session_id, session in
+                    self.sessions.items() if session[0] == username]
+
+    def close(self, timeout=DEFAULT_TIMEOUT):
+        """
+        Stop the open sessions, then send (or spill) the queued records
+        for up to timeout seconds before stopping the sender.
+        """
+        with self._lock:
+            session_ids = list(self.sessions)
+        for session_id in session_ids:
+            self.stop(session_id, TERMINATE_ADMIN_REBOOT)
+        self._stop.set()
+        self._sender.join(timeout)
+        # anything left could not be sent in time
+        while True:
+            try:
+                self._spill(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._executor.shutdown(wait=False)
+
+    def _record(self, status, username, session_id, started, attributes):
+        """Queue a record. Never blocks."""
+        now = time.time()
+        record = {
+            'status': status, 'username': username,
+            'session_id': session_id, 'time': now,
+            'attributes': attributes,
+        }
+        if status != ACCT_STATUS_START:
+            record['attributes']['Acct-Session-Time'] = int(now - started)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            LOGGER.warning('Accounting queue full')
+            self._spill(record)
+
+    def message(self, record):
+        """Build the Accounting-Request for a queued record."""
+        message = Message(self.radius.secret, CODE_ACCOUNTING_REQUEST)
+        attrs = message.attributes
+        attrs[ATTR_ACCT_STATUS_TYPE] = _int_value(record['status'])
+        attrs[ATTR_USER_NAME] = bytes_safe(record['username'])
+        attrs[ATTR_ACCT_SESSION_ID] = bytes_safe(record['session_id'])
+        attrs[ATTR_EVENT_TIMESTAMP] = _int_value(record['time'])
+        attrs[ATTR_ACCT_DELAY_TIME] = _int_value(
+            max(time.time() - record['time'], 0))
+        if self.nas_identifier is not None:
+            attrs[ATTR_NAS_IDENTIFIER] = bytes_safe(self.nas_identifier)
+        for name, value in record['attributes'].items():
+            code = Attributes._code(name)
+            if code in INTEGER_ATTRS:
+                attrs[code] = _int_value(value)
+            else:
+                attrs[code] = value if isinstance(value, bytes) \
+                    else bytes_safe(str(value))
+        return message
+
+    def _send(self, record):
+        """Send a record. Returns False if the server did not answer."""
+        try:
+            message = self.message(record)
+        except (KeyError, TypeError, ValueError, struct.error) as e:
+            LOGGER.warning('Discarding invalid accounting record: %s', e)
+            with self._lock:
+                self.counters['invalid'] += 1
+            return True
+        try:
+            reply = self.radius.send_message(message)
+        except NoResponse:
+            return False
+        with self._lock:
+            if reply.code == CODE_ACCOUNTING_RESPONSE:
+                self.counters['sent'] += 1
+            else:
+                LOGGER.warning('Unexpected reply to Accounting-Request: %s',
+                               CODES.get(reply.code, reply.code))
+                self.counters['invalid'] += 1
+        return True
+
+    def _send_batch(self, records):
+        """Send records concurrently. Unanswered records are spilled."""
+        if len(records) == 1:
+            results = [self._send(records[0])]
+        else:
+            results = list(self._executor.map(self._send, records))
+        failed = [x for x, ok in zip(records, results) if not ok]
+        if failed:
+            LOGGER.warning('No response from accounting server %s:%s, '
+                           'retrying in %ss', self.host, self.port,
+                           self.retry_interval)
+            self._retry_at = monotonic() + self.retry_interval
+            for record in failed:
+                self._spill(record)
+
+    def _run(self):
+        """Sender thread."""
+        next_check = monotonic() + ACCT_CHECK_INTERVAL
+        while not self._stop.is_set() or not self._queue.empty():
+            if self._spill_pending and self.reachable and \
+                    not self._stop.is_set():
+                self._replay()
+            try:
+                records = [self._queue.get(timeout=1.0)]
+            except queue.Empty:
+                records = []
+            while records and len(records) < self.batch_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if records:
+                if self.reachable:
+                    self._send_batch(records)
+                else:
+                    for record in records:
+                        self._spill(record)
+            if monotonic() >= next_check:
+                next_check = monotonic() + ACCT_CHECK_INTERVAL
+                self._check_sessions()
+
+    def _check_sessions(self):
+        """Queue Interim-Update records and stop expired sessions."""
+        now = monotonic()
+        expired, interim = [], []
+        with self._lock:
+            for session_id, (username, started, updated) in \
+                    self.sessions.items():
+                if self.session_timeout and \
+                        time.time() - started >= self.session_timeout:
+                    expired.append(session_id)
+                elif self.interim_interval and \
+                        now - updated >= self.interim_interval:
+                    interim.append(session_id)
+        for session_id in expired:
+            self.stop(session_id, TERMINATE_SESSION_TIMEOUT)
+        for session_id in interim:
+            self.interim(session_id)
+
+    def _spill(self, record):
+        """Save a record to the spill file (or drop it)."""
+        if self.spill_file is None:
+            with self._lock:
+                self.counters['dropped'] += 1
+            return
+        try:
+            with self._spill_lock:
+                line = _dump_record(record)
+                with open(self.spill_file, 'a', encoding='utf-8') as output:
+                    output.write(line)
+                self._spill_pending += 1
+            with self._lock:
+                self.counters['spilled'] += 1
+        except (TypeError, ValueError) as e:
+            LOGGER.error('Unable to spill accounting record: %s', e)
+            with self._lock:
+                self.counters['dropped'] += 1
+        except OSError as e:
+            LOGGER.error('Unable to write accounting spill file %s: %s',
+                         self.spill_file, e)
+            with self._lock:
+                self.counters['dropped'] += 1
+
+    def _count_spilled(self):
+        """Number of records waiting in the spill files."""
+        count = 0
+        for path in (self.spill_file, self._replay_file):
+            if path is not None and os.path.isfile(path):
+                with open(path, 'r', encoding='utf-8') as input_file:
+                    count += sum(1 for line in input_file if line.strip())
+        return count
+
+    @property
+    def _replay_file(self):
+        return self.spill_file + '.replay' if self.spill_file else None
+
+    def _replay(self):
+        """
+        Resend spilled records in order. The spill file is moved aside
+        first so records spilled meanwhile are kept. Records that still
+        can not be sent are written back to the replay file.
+        """
+        with self._spill_lock:
+            if not os.path.isfile(self._replay_file):
+                if not os.path.isfile(self.spill_file):
+                    self._spill_pending = 0
+                    return
+                os.replace(self.spill_file, self._replay_file)
+        with open(self._replay_file, 'r', encoding='utf-8') as input_file:
+            lines = [line for line in input_file if line.strip()]
+        LOGGER.info('Resending %s spilled accounting records', len(lines))
+        for i in range(0, len(lines), self.batch_size):
+            if self._stop.is_set():
+                return
+            records = []
+            for line in lines[i:i + self.batch_size]:
+                try:
+                    records.append(_load_record(line))
+                except ValueError:
+                    LOGGER.warning('Discarding invalid spilled record')
+            results = list(self._executor.map(self._send, records))
+            if not all(results):
+                self._retry_at = monotonic() + self.retry_interval
+                remaining = [_dump_record(x) for x, ok in
+                             zip(records, results) if not ok] + \
+                    lines[i + self.batch_size:]
+                with open(self._replay_file + '.tmp', 'w',
+                          encoding='utf-8') as output:
+                    output.writelines(remaining)
+                os.replace(self._replay_file + '.tmp', self._replay_file)
+                with self._spill_lock:
+                    self._spill_pending = self._count_spilled()
+                return
+        os.unlink(self._replay_file)
+        with self._spill_lock:
+            self._spill_pending = self._count_spilled()
+
+
+def _dump_record(record):
+    """
+    Return an accounting record as a JSON line. bytes attribute values are
+    saved as {"hex": ...}.
+    """
+    return json.dumps(record, default=lambda value: {'hex': value.hex()}
+                      if isinstance(value, (bytes, bytearray))
+                      else str(value)) + '\n'
+
+
+def _load_record(line):
+    """Return an accounting record saved by _dump_record."""
+    record = json.loads(line)
+    record['attributes'] = {
+        name: bytes.fromhex(value['hex']) if isinstance(value, dict) and
+        set(value) == {'hex'} else value
+        for name, value in record.get('attributes', {}).items()}
+    return record
+
+
+def _attribute_names(attributes):
+    """
+    Return keyword attributes with _ replaced by - in the names. Raises
+    ValueError for unknown attributes.
+    """
+    result = {}
+    for name, value in attributes.items():
+        name = name.replace('_', '-')
+        try:
+            Attributes._code(name)
+        except KeyError:
+            raise ValueError('Invalid radius attribute: %s' % name)
+        result[name] = value
+    return result
+
+
+def _int_value(value):
+    """Pack an integer attribute value."""
+    return struct.pack('!I', int(value) & 0xffffffff)
+
+
+def cooperative(func, *args, **kwargs):
+    """
+    Call a blocking radius function without stalling a gevent hub.
+
+    If gevent is in use but the socket module is not monkey patched the
+    blocking request would stall the whole hub, so it is run in the gevent
+    threadpool instead. Otherwise func is called directly.
+    """
+    if 'gevent' in sys.modules:
+        import gevent
+        import gevent.monkey
+        if not gevent.monkey.is_module_patched('socket') and \
+                gevent.getcurrent() is not gevent.get_hub():
+            # exceptions are passed back rather than raised in the pool
+            # so ChallengeResponse is not reported as a pool error
+            result, error = gevent.get_hub().threadpool.apply(
+                _call_result, (func,) + args, kwargs)
+            if error is not None:
+                raise error
+            return result
+    return func(*args, **kwargs)
+
+
+def offload(func, *args, **kwargs):
+    """
+    Call a CPU bound function (i.e. password hashing) without stalling a
+    gevent hub.
+
+    Monkey patching does not help CPU bound work, so under gevent func is
+    always run in the gevent threadpool (hashlib releases the GIL while
+    hashing). Otherwise func is called directly.
+    """
+    if 'gevent' in sys.modules:
+        import gevent
+        if gevent.getcurrent() is not gevent.get_hub():
+            return gevent.get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
+
+
+def _call_result(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs), None
+    except Error as e:
+        return None, e
 
 
 # Don't break code written for radius.py distributed with the ZRadius
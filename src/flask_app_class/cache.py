@@ -0,0 +1,152 @@
+'''
+Small in-process caching helpers shared by the Flask app and the user controllers
+'''
+
+from collections import OrderedDict
+from threading import Lock, Event
+from time import monotonic
+from typing import Callable, Hashable
+
+_MISSING = object()
+
+
+class LRUCache:
+    ''' Thread safe LRU cache with optional entry count and byte budgets.  Entries may carry a TTL (seconds) '''
+    def __init__(self, max_entries:int|None=None, max_bytes:int|None=None, ttl:float|None=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict() # key -> (value, size, expires)
+        self._lock = Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key:Hashable):
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    @property
+    def size_bytes(self) -> int:
+        ''' Total size of all cached entries as reported to set() '''
+        return self._bytes
+
+    @property
+    def stats(self) -> dict:
+        ''' Returns a dict of the cache counters '''
+        return {'entries': len(self._data), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def get(self, key:Hashable, default=None, count=True):
+        ''' Return the value for key and mark it as recently used.  Expired entries are removed and treated as a miss '''
+        with self._lock:
+            item = self._data.get(key, None)
+            if item is not None and item[2] is not None and item[2] <= monotonic():
+                self._remove(key)
+                item = None
+            if item is None:
+                if count:
+                    self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            if count:
+                self.hits += 1
+            return item[0]
+
+    def set(self, key:Hashable, value, size:int=0, ttl:float|None=None):
+        ''' Add or replace an entry.  Entries larger than the byte budget are not cached '''
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.pop(key)
+            return
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, size, monotonic() + ttl if ttl else None)
+            self._bytes += size
+            while (self.max_entries is not None and len(self._data) > self.max_entries) or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def pop(self, key:Hashable, default=None):
+        ''' Remove an entry and return its value '''
+        with self._lock:
+            if key in self._data:
+                return self._remove(key)
+        return default
+
+    def invalidate(self, match:Callable|None=None) -> int:
+        ''' Remove all entries, or only the entries where match(key) is True.  Returns the number of entries removed '''
+        with self._lock:
+            keys = [key for key in self._data if match is None or match(key)]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def clear(self):
+        ''' Remove all entries and reset the counters '''
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def _remove(self, key:Hashable):
+        ''' Remove an entry, lock must be held by the caller '''
+        value, size, _ = self._data.pop(key)
+        self._bytes -= size
+        return value
+
+
+
+class SingleFlight:
+    ''' Coalesces concurrent calls that share a key into a single call.  Callers that arrive while a call is in flight wait for it
+        and share its result (or exception).  waiter is called with the threading.Event to wait on, i.e. to wait cooperatively under gevent '''
+    def __init__(self, waiter:Callable|None=None):
+        self._waiter = waiter if waiter is not None else (lambda event: event.wait())
+        self._calls = {}
+        self._lock = Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    @property
+    def stats(self) -> dict:
+        ''' Returns the call counters '''
+        return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._calls)}
+
+    def do(self, key:Hashable, func:Callable, *args, **kwargs):
+        ''' Call func(*args, **kwargs), or wait for the result of the call already in flight for key '''
+        with self._lock:
+            call = self._calls.get(key, None)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _FlightCall()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            self._waiter(call.event)
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result
+
+
+class _FlightCall:
+    ''' Result holder for a call in flight '''
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.error = None
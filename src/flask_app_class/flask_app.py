@@ -1,20 +1,29 @@
-from flask import Flask, render_template, send_from_directory, g, session, send_file, abort
-from flask import Flask, flash, redirect, render_template, request, session, abort, url_for, jsonify
-from flask_login import LoginManager, login_user, current_user, logout_user, login_required
+from flask import Flask, render_template, send_from_directory, g, session, send_file, abort, has_app_context
+from flask.globals import request_ctx
+from flask import Flask, flash, redirect, render_template, request, session, abort, url_for, jsonify, stream_template
+from flask_login import LoginManager, login_user, current_user, logout_user, login_required, user_logged_in, user_logged_out
 from urllib.parse import urlparse, urljoin
 import os
+import sys
 import json
-import inspect
 import logging
 from datetime import datetime, timedelta
 from threading import Lock, Thread
-from time import sleep
+from time import sleep, perf_counter
 import uuid
 import re, glob
+from functools import wraps
 from typing import Callable
 from flask_socketio import SocketIO, emit, disconnect
 from werkzeug.middleware.proxy_fix import ProxyFix
+from jinja2 import FileSystemBytecodeCache, TemplateError
 from logging_handler import create_logger, DEBUG, INFO, WARNING, ERROR, CRITICAL, _log_level_number
+from .static_cache import StaticCache, precompress_files, send_static_entry, DEFAULT_STATIC_CACHE_BYTES, DEFAULT_STATIC_CACHE_FILE_SIZE, DEFAULT_STATIC_CHECK_INTERVAL, \
+    DEFAULT_PRECOMPRESS_MIN_SIZE, PRECOMPRESSED_VARIANTS
+from .response_cache import ResponseCache, DEFAULT_RESPONSE_CACHE_ENTRIES, DEFAULT_RESPONSE_CACHE_BYTES, DEFAULT_RESPONSE_CACHE_TTL
+from .static_manifest import StaticManifest, StaticWatcher, hash_file, DEFAULT_MANIFEST_FILE, DEFAULT_SCAN_WORKERS, DEFAULT_POLL_INTERVAL
+from .session_store import ServerSessionInterface, create_session_store, DEFAULT_SESSION_TTL
+from .log_queue import LogQueue
 
 '''
 ==================================
@@ -23,7 +32,13 @@ Global Variables available in to all modules
 '''
 FLASK_SECRET_LENGTH = 128
 FLASK_DEFAULT_STATIC_DIR = 'static'
+STATIC_ROUTING_RULES = 'rules'          # one url rule per static file
+STATIC_ROUTING_CATCH_ALL = 'catch_all'  # single catch all url rule resolved against the static_pages index
+STATIC_FINGERPRINT_LENGTH = 10
+STATIC_FINGERPRINT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
 BASE_TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'base_templates')
+TEMPLATE_EXTENSIONS = ('.html', '.htm', '.j2', '.jinja', '.jinja2', '.xml', '.txt')
+DEFAULT_LOG_FLUSH_TIMEOUT = 5
 
 
 def load_config_json(config_file:str):
@@ -35,15 +50,123 @@ def load_config_json(config_file:str):
 
 
 class FlaskLogFilter(logging.Filter):
-    ''' Class to handle filtering of web log mess '''
-    log_filter_list = []
-    
+    ''' Class to handle filtering of web log mess.  Entries of the filter list are compiled once into a single regex:
+            "HEAD /healthz"                                  - drop messages containing the string
+            "re:^GET /api/v[0-9]+/status"                    - drop messages matching the regex
+            {"pattern": "/healthz", "sample": 1000}          - log 1 in every 1000 matching messages, drop the rest
+            {"pattern": "^POST /poll", "regex": true}        - dict form of a regex entry (sample is optional)
+        If a message matches more than one entry the leftmost match in the message is used.  Duplicate entries are ignored (the first
+        one is used).  Assigning log_filter_list compiles the new list, call recompile() after changing the list in place '''
+    def __init__(self, log_filter_list:list|None=None, name:str=''):
+        super().__init__(name)
+        self._lock = Lock()
+        self._compiled = (None, {})
+        self._matched = {}
+        self._dropped = {}
+        # compile now so bad entries are reported when the filter is created
+        self.log_filter_list = log_filter_list if log_filter_list is not None else []
+
+    @property
+    def log_filter_list(self) -> list:
+        ''' Returns the filter list entries '''
+        return self._log_filter_list
+
+    @log_filter_list.setter
+    def log_filter_list(self, log_filter_list:list):
+        with self._lock:
+            self._compile(log_filter_list)
+            self._log_filter_list = log_filter_list
+
+    def recompile(self):
+        ''' Compile the filter list again, needed after entries are added, removed or edited in place '''
+        with self._lock:
+            self._compile(self._log_filter_list)
+
+    @staticmethod
+    def parse_entry(entry) -> tuple:
+        ''' Returns (name, pattern, is_regex, sample) for a filter list entry.  sample is None if all matching messages are dropped.
+            Entries with the same name match the same messages ('re:' + pattern for regex entries) '''
+        if isinstance(entry, str):
+            if entry.startswith('re:'):
+                return entry, entry[3:], True, None
+            return entry, entry, False, None
+        if isinstance(entry, dict) and isinstance(entry.get('pattern', None), str):
+            sample = entry.get('sample', None)
+            if sample is not None and (not isinstance(sample, int) or isinstance(sample, bool) or sample < 1):
+                raise ValueError(f"web_log_filter sample must be a positive integer. Got: {entry}")
+            is_regex = bool(entry.get('regex', False))
+            return ('re:' if is_regex else '') + entry['pattern'], entry['pattern'], is_regex, sample
+        raise ValueError(f"web_log_filter entries must be a string or a dict with a 'pattern'. Got: {entry}")
+
+    @staticmethod
+    def _literal_trie(literals:dict) -> str:
+        ''' Returns a regex matching any of the literal strings (dict of string -> marker group).  Common prefixes are factored out so
+            the regex engine can skip ahead on the first character instead of trying every alternative at every position '''
+        trie = {}
+        for literal, marker in literals.items():
+            node = trie
+            for char in literal:
+                node = node.setdefault(char, {})
+            node.setdefault('', marker)
+
+        def build(node:dict) -> str:
+            alternatives = [re.escape(char) + build(node[char]) for char in sorted(node) if char != '']
+            if '' in node:
+                alternatives.append(node[''])
+            return alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+        return build(trie)
+
+    def _compile(self, log_filter_list:list):
+        ''' Build the combined regex.  Each entry ends with an empty named group so the matching entry is known from match.lastgroup
+            without a second scan (wrapping each entry in a group would defeat the regex engine's prefix search) '''
+        entries = {}
+        for entry in log_filter_list:
+            name, pattern, is_regex, sample = self.parse_entry(entry)
+            entries.setdefault(name, (name, pattern, is_regex, sample))
+        entries = list(entries.values())
+        literals, alternatives = {}, []
+        for index, (name, pattern, is_regex, _) in enumerate(entries):
+            if not is_regex:
+                literals[pattern] = f"(?P<_f{index}>)"
+                continue
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise ValueError(f"web_log_filter entry '{name}' is not a valid regex: {e}") from e
+            alternatives.append(f"(?:{pattern})(?P<_f{index}>)")
+        if literals:
+            alternatives.insert(0, self._literal_trie(literals))
+        # regex and marker group -> (name, sample) are swapped together so filter() never sees a mix of two compiles
+        self._compiled = (re.compile('|'.join(alternatives)) if alternatives else None,
+                          {f"_f{index}": (name, sample) for index, (name, _, _, sample) in enumerate(entries)})
+        # counts of entries that are still in the list are kept
+        self._matched = {name: self._matched.get(name, 0) for name, _, _, _ in entries}
+        self._dropped = {name: self._dropped.get(name, 0) for name, _, _, _ in entries}
+
+    @property
+    def stats(self) -> dict:
+        ''' Returns the matched and dropped counts of each filter list entry '''
+        with self._lock:
+            return {name: {'matched': self._matched[name], 'dropped': self._dropped[name]} for name in self._matched}
+
     def filter(self, record):
         ''' Filter out selected log messages - returns FALSE if message should be filtered '''
-        for filter in self.log_filter_list:
-            if filter in record.getMessage():
+        regex, entries = self._compiled
+        if regex is None:
+            return True
+        match = regex.search(record.getMessage())
+        if match is None:
+            return True # don't filter!
+        name, sample = entries[match.lastgroup]
+        with self._lock:
+            if name not in self._matched:
+                # removed by a recompile since the match
                 return False
-        return True # don't filter!
+            self._matched[name] += 1
+            if sample is not None and (self._matched[name] - 1) % sample == 0:
+                return True # sampled, log this one
+            self._dropped[name] += 1
+        return False
 
 class FlaskApp:
     ''' Class to hold and manage all the general flask related data and functions '''
@@ -83,11 +206,22 @@ class FlaskApp:
         }
         self.api_pages = {}
         self.web_log_filter = ['HEAD /healthz']
+        self.web_log_filter_obj = None
         self._shutdown_post_uuid = str(uuid.uuid4())
+        self._template_paths = {}
+        self.response_cache = None
+        self.session_store = None
+        self.log_queue = None
 
         # mapping of static path overrides and all static content pages
         self.static_pages = {}
         self.static_page_args = {}
+        self.static_cache = None
+        self.static_manifest = None
+        self._static_manifest_config = {}
+        self.static_watcher = None
+        self.static_fingerprints = {}
+        self._static_fingerprint_routes = {}  # fingerprinted route -> (route, (mtime_ns, size) of the fingerprinted content)
 
         # shutdown flags
         self._shutdown = False
@@ -119,32 +253,102 @@ class FlaskApp:
         if self.config.get('auth', '').lower() == 'radius' or self.config.get('authentication', '').lower() == 'radius':
             from .user_radius import RadiusUserController
             self.user_controller = RadiusUserController(**self.config.get('radius'))
-            self.login_manager.user_loader(self.user_controller.get_user)
+            self.login_manager.user_loader(self.user_controller.load_user)
         else:
             from .user_generic import GenericUserController
             self.user_controller = GenericUserController()
-            self.login_manager.user_loader(self.user_controller.get_user)
+            self.login_manager.user_loader(self.user_controller.load_user)
+        user_logged_in.connect(self._user_logged_in, self.app)
+        user_logged_out.connect(self._user_logged_out, self.app)
+
+    def _user_logged_in(self, sender, user, **kwargs):
+        ''' flask_login signal, let the user controller know a web session started.  Server side sessions get a new id '''
+        if hasattr(session, 'regenerate'):
+            session.regenerate()
+        if self.user_controller is not None and user is not None:
+            self.user_controller.session_started(user.get_id())
+
+    def _user_logged_out(self, sender, user, **kwargs):
+        ''' flask_login signal, let the user controller know a web session ended '''
+        if self.user_controller is not None and user is not None and user.is_authenticated:
+            self.user_controller.session_ended(user.get_id())
 
     def init(self):
         ''' Stop the running process and recreate all Flask objects.  Allows a complete reset of the Flask environment with all routes '''
         self.stop()
         self.config = load_config_json(self.config_file) if self.config_file is not None else {}
+        self._template_paths = {}
+        self.static_pages = {}
+        self.static_fingerprints = {}
+        self._static_fingerprint_routes = {}
+
+        # queued logging - records are written by a background thread instead of the request thread
+        log_queue_config = self.config.get('log_queue', False)
+        if log_queue_config:
+            log_queue_config = log_queue_config if isinstance(log_queue_config, dict) else {}
+            self.log_queue = LogQueue.from_config([self.app_logger, self.flask_logger, logging.getLogger('werkzeug')], log_queue_config)
+            self.log_queue.start()
+        self._patch_access_log(self.log_queue is not None)
 
         # flask objects
         self.app = Flask(__name__, static_folder=self.config.get('static_dir', os.path.join(os.getcwd(), FLASK_DEFAULT_STATIC_DIR)), template_folder=self.site_data['templates_path'])
         self.web_static_dir = self.config.get('static_dir', FLASK_DEFAULT_STATIC_DIR)
         self.web_static_inc_subs = self.config.get('web_static_inc_subs', True)
+        self.static_routing = self.config.get('static_routing', STATIC_ROUTING_RULES)
+        if self.static_routing not in (STATIC_ROUTING_RULES, STATIC_ROUTING_CATCH_ALL):
+            raise ValueError(f"static_routing must be '{STATIC_ROUTING_RULES}' or '{STATIC_ROUTING_CATCH_ALL}'. Got: {self.static_routing}")
         self.app.wsgi_app = ProxyFix(self.app.wsgi_app, **dict(x_proto=1, x_host=1, x_for=1, x_prefix=1) if self.config.get('behind_proxy', False) else {})
         self.socketio = SocketIO(self.app, cors_allowed_origins=self.config.get('cors_allowed_origins', '*'))
+        self.app.jinja_env.globals['static_url'] = self.static_url
+        self.app.jinja_env.filters['asset'] = self.static_url
+        if self.config.get('jinja_bytecode_cache', None) is not None:
+            # compiled templates are shared by all workers and survive restarts
+            os.makedirs(self.config['jinja_bytecode_cache'], exist_ok=True)
+            self.app.jinja_env.bytecode_cache = FileSystemBytecodeCache(self.config['jinja_bytecode_cache'])
+
+        # server side sessions - the session cookie only carries the session id
+        session_config = self.config.get('session', None)
+        if session_config:
+            session_config = session_config if isinstance(session_config, dict) else {}
+            self.session_store = create_session_store(session_config, logger=self.app_logger)
+            self.app.session_interface = ServerSessionInterface(self.session_store, ttl=session_config.get('ttl', DEFAULT_SESSION_TTL))
+
+        # static file cache - set 'static_cache' to true (or a dict of options) to hold static files in memory (per worker, up to max_bytes).
+        # Files larger than max_file_size are not cached and are streamed from disk
+        static_cache_config = self.config.get('static_cache', False)
+        if static_cache_config:
+            static_cache_config = static_cache_config if isinstance(static_cache_config, dict) else {}
+            self.static_cache = StaticCache(max_bytes=static_cache_config.get('max_bytes', DEFAULT_STATIC_CACHE_BYTES),
+                                            max_file_size=static_cache_config.get('max_file_size', DEFAULT_STATIC_CACHE_FILE_SIZE),
+                                            check_interval=static_cache_config.get('check_interval', DEFAULT_STATIC_CHECK_INTERVAL),
+                                            cache_control=self.config.get('static_cache_control', {}))
+        else:
+            self.static_cache = None
+
+        # page response / fragment cache, used by pages with a 'cache' block in their config
+        response_cache_config = self.config.get('response_cache', {}) if isinstance(self.config.get('response_cache', {}), dict) else {}
+        self.response_cache = ResponseCache(max_entries=response_cache_config.get('max_entries', DEFAULT_RESPONSE_CACHE_ENTRIES),
+                                            max_bytes=response_cache_config.get('max_bytes', DEFAULT_RESPONSE_CACHE_BYTES))
+
+        # static manifest - persists the static file scan between restarts and optionally watches for changes
+        static_manifest_config = self.config.get('static_manifest', False)
+        if static_manifest_config:
+            self._static_manifest_config = static_manifest_config if isinstance(static_manifest_config, dict) else {}
+            self.static_manifest = StaticManifest(manifest_file=self._static_manifest_config.get('file', DEFAULT_MANIFEST_FILE),
+                                                  workers=self._static_manifest_config.get('workers', DEFAULT_SCAN_WORKERS),
+                                                  logger=self.app_logger)
+        else:
+            self.static_manifest = None
 
         # logging filter
         self.web_log_filter = self.config.get('web_log_filter', self.web_log_filter)
         if not isinstance(self.web_log_filter, list):
-            raise ValueError(f"web_log_filter mus be a list of string objects to match against logs. Got: {self.web_log_filter}")
-        web_log_filter_obj = FlaskLogFilter()
-        web_log_filter_obj.log_filter_list = self.web_log_filter
+            raise ValueError(f"web_log_filter mus be a list of strings or pattern dicts to match against logs. Got: {self.web_log_filter}")
         werkzeug_logger = logging.getLogger('werkzeug')
-        werkzeug_logger.addFilter(web_log_filter_obj)
+        if self.web_log_filter_obj is not None:
+            werkzeug_logger.removeFilter(self.web_log_filter_obj)
+        self.web_log_filter_obj = FlaskLogFilter(self.web_log_filter)
+        werkzeug_logger.addFilter(self.web_log_filter_obj)
 
         self.site_data['base_template'] = self.config.get('base_template', None) if self.config.get('base_template', None) in self.base_templates else None
         self.site_data['debug'] = self.config.get('debug', False)
@@ -194,6 +398,10 @@ class FlaskApp:
                 self.app_logger.info(f"{self.info_str}: Writing flask secret file {self.config.get('flask_secret_file', '.flask_secret')}")
                 output_file.write(self.app.secret_key)
         self.update_flask_routes(reinit=False)
+        if self.config.get('template_warmup', False):
+            self.precompile_templates()
+        if self.static_manifest is not None and self._static_manifest_config.get('watch', True):
+            self.start_static_watcher()
 
         # configure dropdowns
         for dropdown_menu in self.config.get('dropdowns', []):
@@ -270,36 +478,237 @@ class FlaskApp:
         ''' Update the flask routes '''
         if reinit or self.app is None:
             self.init()
-        # add base template static files
-        if self.site_data.get('base_template', None) is not None and os.path.isdir(os.path.join(self.site_data['templates_path'], '_base_template', 'static')):
-            self._add_flask_static_files(os.path.join(self.site_data['templates_path'], '_base_template', 'static'))
-        # add app static files
-        if self.site_data.get('app_path', None) is not None and os.path.isdir(os.path.join(self.site_data['templates_path'], '_app', 'static')):
-            self._add_flask_static_files(os.path.join(self.site_data['templates_path'], '_app', 'static'))
-        # add static files from the project
-        self._add_flask_static_files(os.path.join(os.getcwd(), self.config.get('static_dir', FLASK_DEFAULT_STATIC_DIR)))
+        # add static files from the base template, app and project
+        if self.static_manifest is not None:
+            static_files = self.static_manifest.scan(self.static_roots)
+        else:
+            static_files = {root: get_all_files(root, True) for root in self.static_roots}
+        for root_path, files in static_files.items():
+            self._add_flask_static_files(root_path, files)
+        if self.config.get('static_fingerprint', False):
+            self._add_static_fingerprints(self.static_pages)
+            if self.static_routing == STATIC_ROUTING_RULES:
+                for fingerprint_route in self._static_fingerprint_routes:
+                    self.app.add_url_rule(fingerprint_route, view_func=self.web_static_file, **self.static_page_args)
+        if self.static_routing == STATIC_ROUTING_CATCH_ALL:
+            # converter rules are matched after all fixed rules, so dynamic pages still take priority
+            self.app.add_url_rule('/<path:static_path>', view_func=self.web_static_index, **self.static_page_args)
+        if self.config.get('static_precompress', False):
+            self.precompress_static()
 
         # add dynamic pages
         for page in self.web_pages:
+            view_func = self._page_view(page, self.web_pages[page])
             for route in self.web_pages[page]['routes']:
-                self.app.add_url_rule(route, view_func=getattr(self, page), **self.web_pages[page].get('params', {}))
+                self.app.add_url_rule(route, view_func=view_func, **self.web_pages[page].get('params', {}))
 
         # add api pages
         for page in self.api_pages:
+            view_func = self._page_view(page, self.api_pages[page])
             for route in self.api_pages[page]['routes']:
-                self.app.add_url_rule(route, view_func=getattr(self, page), **self.api_pages[page].get('params', {}))
+                self.app.add_url_rule(route, view_func=view_func, **self.api_pages[page].get('params', {}))
+
+    def _page_view(self, page:str, page_config:dict) -> Callable:
+        ''' Wrap a page method so the page name is available to render_template for the request (g.flask_app_page).
+            Pages with a 'roles' list require a logged in user with one of the roles (403 otherwise).
+            Pages with a 'cache' block are served from the response cache, with 'roles' the cache must set vary_user '''
+        page_func = getattr(self, page)
+        cache_config = page_config.get('cache', None)
+        roles = page_config.get('roles', None)
+        if roles is not None and cache_config is not None and not cache_config.get('vary_user', False):
+            raise ValueError(f"Page {page} has 'roles' and 'cache', the cache must set 'vary_user' so users do not share cached responses")
+
+        @wraps(page_func)
+        def page_view(*args, **kwargs):
+            g.flask_app_page = page
+            if roles is not None:
+                if not current_user.is_authenticated:
+                    return self.login_manager.unauthorized()
+                if self.user_controller.authorize_user(current_user.get_id(), roles=roles) is not True:
+                    abort(403)
+            if cache_config is not None and request.method in ('GET', 'HEAD'):
+                return self._cached_page_response(page, page_func, cache_config, *args, **kwargs)
+            return page_func(*args, **kwargs)
+        return page_view
+
+    def _cached_page_response(self, page:str, page_func:Callable, cache_config:dict, *args, **kwargs):
+        ''' Return the page from the response cache, or call the page and cache a successful response.
+            Requests from a logged in user bypass the cache unless the page sets vary_user (the page may depend on current_user).
+            Responses are not cached if the page set a cookie, or used the session without vary_user (the session cookie is only
+            added after the page returns).  Vary lists the request headers that are part of the cache key '''
+        vary = list(cache_config.get('vary_headers', [])) + (['Cookie'] if cache_config.get('vary_user', False) else [])
+        authenticated = bool(current_user) and current_user.is_authenticated
+        if authenticated and not cache_config.get('vary_user', False):
+            response = self.app.make_response(page_func(*args, **kwargs))
+            response.vary.update(vary)
+            return response
+        user_id = current_user.get_id() if cache_config.get('vary_user', False) and authenticated else None
+        key = ResponseCache.request_key(page, cache_config, request, user_id=user_id)
+        entry = self.response_cache.get(page, key)
+        if entry is None:
+            # only count session use by the page itself.  The session proxy marks the session accessed, so use the session object
+            request_session = _request_session()
+            accessed = request_session.accessed
+            request_session.accessed = False
+            try:
+                response = self.app.make_response(page_func(*args, **kwargs))
+            finally:
+                page_accessed = request_session.accessed
+                request_session.accessed = accessed or page_accessed
+            if response.status_code != 200 or response.is_streamed or 'Set-Cookie' in response.headers or \
+                    request_session.modified or (page_accessed and not cache_config.get('vary_user', False)):
+                response.vary.update(vary)
+                return response
+            entry = self.response_cache.set(key, response.get_data(), response.status_code,
+                                            [header for header in response.headers.items() if header[0] not in ('Content-Length', 'ETag')],
+                                            ttl=cache_config.get('ttl', DEFAULT_RESPONSE_CACHE_TTL))
+        response = self.app.response_class(entry.body, status=entry.status, headers=entry.headers)
+        response.vary.update(vary)
+        response.set_etag(entry.etag)
+        return response.make_conditional(request)
+
+    def render_fragment(self, template:str, cache_key:str, ttl:float=DEFAULT_RESPONSE_CACHE_TTL, **kwargs) -> str:
+        ''' Render a template (i.e. a partial included in a larger page) through the fragment cache '''
+        fragment = self.response_cache.get_fragment(cache_key)
+        if fragment is None:
+            fragment = self.render_template(template, **kwargs)
+            self.response_cache.set_fragment(cache_key, fragment, ttl=ttl)
+        return fragment
+
+    def invalidate_cache(self, page:str|None=None, fragment:str|None=None) -> int:
+        ''' Remove cached responses for a page, a cached fragment, or everything if neither is given '''
+        count = self.response_cache.invalidate(page=page, fragment=fragment)
+        self.app_logger.debug(f"{self.info_str}: Invalidated {count} cached responses (page={page}, fragment={fragment})")
+        return count
+
+    @property
+    def cache_stats(self) -> dict:
+        ''' Returns the response cache counters '''
+        return self.response_cache.stats
 
-    def _add_flask_static_files(self, root_path):
-        ''' Loop through all files in the path specified and add as static files.  If '_base_template', files will be added WITHOUT the '_base_template' in the route '''
-        for static_file in get_all_files(root_path, True):
+    @property
+    def static_roots(self) -> list:
+        ''' Returns the static file directories in order of precedence, later roots override earlier roots (base template -> app -> project) '''
+        roots = []
+        if self.site_data.get('base_template', None) is not None and os.path.isdir(os.path.join(self.site_data['templates_path'], '_base_template', 'static')):
+            roots.append(os.path.join(self.site_data['templates_path'], '_base_template', 'static'))
+        if self.site_data.get('app_path', None) is not None and os.path.isdir(os.path.join(self.site_data['templates_path'], '_app', 'static')):
+            roots.append(os.path.join(self.site_data['templates_path'], '_app', 'static'))
+        roots.append(os.path.join(os.getcwd(), self.config.get('static_dir', FLASK_DEFAULT_STATIC_DIR)))
+        return roots
+
+    def start_static_watcher(self):
+        ''' Start watching the static roots for added, changed or removed files.  Requires the static manifest '''
+        if self.static_manifest is None:
+            raise ValueError("The static watcher requires 'static_manifest' to be enabled")
+        if self.static_routing == STATIC_ROUTING_RULES:
+            self.app_logger.warning(f"{self.info_str}: static_routing '{STATIC_ROUTING_RULES}' can not add routes for new static files after startup. Use '{STATIC_ROUTING_CATCH_ALL}'.")
+        self.stop_static_watcher()
+        self.static_watcher = StaticWatcher(self.static_manifest, self.static_roots, self._static_files_changed,
+                                            poll_interval=self._static_manifest_config.get('poll_interval', DEFAULT_POLL_INTERVAL), logger=self.app_logger)
+        self.static_watcher.start()
+
+    def stop_static_watcher(self):
+        ''' Stop the static watcher if running '''
+        if self.static_watcher is not None:
+            self.static_watcher.stop()
+            self.static_watcher = None
+
+    def _static_files_changed(self, static_files:dict, changed:set):
+        ''' Called by the static watcher with the current files for each root.  Rebuilds the static_pages index '''
+        static_pages = {}
+        for root_path, files in static_files.items():
+            for static_file in without_precompressed(files):
+                static_pages[static_file.split(root_path)[1]] = static_file
+        if self.config.get('static_fingerprint', False):
+            self._add_static_fingerprints(static_pages)
+        self.app_logger.info(f"{self.info_str}: Static files changed, {len(static_pages)} static pages ({len(static_pages) - len(self.static_pages):+d})")
+        self.static_pages = static_pages
+        if self.static_cache is not None:
+            for path in changed:
+                self.static_cache.invalidate(path)
+
+    def _add_static_fingerprints(self, static_pages:dict):
+        ''' Add a content fingerprinted route (i.e. /js/app.3f9a1c4d2e.js) to static_pages for every static file.
+            Fingerprinted routes are served with an immutable Cache-Control header '''
+        fingerprints = {}
+        fingerprint_routes = {}
+        for route, static_file in list(static_pages.items()):
+            if route in self._static_fingerprint_routes:
+                # already a fingerprinted route
+                continue
+            try:
+                stat = os.stat(static_file)
+            except OSError:
+                continue
+            file_hash = (self.static_manifest.file_hash(static_file) if self.static_manifest is not None else None) or hash_file(static_file)
+            if file_hash is None:
+                continue
+            fingerprints[route] = fingerprint_route(route, file_hash)
+            fingerprint_routes[fingerprints[route]] = (route, (stat.st_mtime_ns, stat.st_size))
+            static_pages[fingerprints[route]] = static_file
+        self.static_fingerprints = fingerprints
+        self._static_fingerprint_routes = fingerprint_routes
+
+    def _static_fingerprint_current(self, route:str) -> bool:
+        ''' Check that the file behind a fingerprinted route still has the fingerprinted content (it may have been edited without the
+            static watcher running).  The file is only hashed again if its mtime or size changed '''
+        base_route, fingerprinted_stat = self._static_fingerprint_routes[route]
+        if fingerprinted_stat is None:
+            return False
+        try:
+            if self.static_cache is not None:
+                entry = self.static_cache.lookup(self.static_pages[route])
+                current_stat = (entry.mtime_ns, entry.size)
+            else:
+                stat = os.stat(self.static_pages[route])
+                current_stat = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return False
+        if current_stat == fingerprinted_stat:
+            return True
+        file_hash = entry.etag if self.static_cache is not None and entry.data is not None else hash_file(self.static_pages[route])
+        if file_hash is not None and fingerprint_route(base_route, file_hash) == route:
+            # touched, content unchanged
+            self._static_fingerprint_routes[route] = (base_route, current_stat)
+            return True
+        # stale, templates get the plain route until the fingerprints are rebuilt (static watcher or init)
+        self._static_fingerprint_routes[route] = (base_route, None)
+        if self.static_fingerprints.get(base_route, None) == route:
+            self.static_fingerprints.pop(base_route, None)
+        return False
+
+    def static_url(self, route:str) -> str:
+        ''' Resolve a static route to its fingerprinted route if static fingerprinting is enabled.
+            Available in templates as {{ static_url('/js/app.js') }} or {{ '/js/app.js' | asset }} '''
+        route = route if route.startswith('/') else '/' + route
+        return self.static_fingerprints.get(route, route)
+
+    def _add_flask_static_files(self, root_path, files:list|None=None):
+        ''' Loop through all files in the path specified (or the provided list of files under the path) and add as static files.
+            If '_base_template', files will be added WITHOUT the '_base_template' in the route.
+            Later roots override earlier roots for the same route (base template -> app -> project).
+            Precompressed .gz / .br siblings are served through their original file and are not added '''
+        for static_file in without_precompressed(files if files is not None else get_all_files(root_path, True)):
             self.static_pages[static_file.split(root_path)[1]] = static_file
-            self.app.add_url_rule(static_file.split(root_path)[1], view_func=self.web_static_file, **self.static_page_args)
+            if self.static_routing == STATIC_ROUTING_RULES:
+                self.app.add_url_rule(static_file.split(root_path)[1], view_func=self.web_static_file, **self.static_page_args)
+
+    def precompress_static(self) -> int:
+        ''' Build .gz / .br siblings for all compressible static files.  Served to clients that accept them when the static cache is enabled '''
+        precompress_config = self.config.get('static_precompress', {})
+        min_size = precompress_config.get('min_size', DEFAULT_PRECOMPRESS_MIN_SIZE) if isinstance(precompress_config, dict) else DEFAULT_PRECOMPRESS_MIN_SIZE
+        written = precompress_files(list(self.static_pages.values()), min_size=min_size)
+        self.app_logger.info(f"{self.info_str}: Precompressed {written} static file variants")
+        return written
 
     def shutdown_server(self):
         ''' Execute a shutdown of the server, must be a POST and include the UUID in the body '''
         if request.method == 'POST' and request.form.get('UUID', None) == self._shutdown_post_uuid:
             if isinstance(self.socketio, SocketIO):
                 self.app_logger.info(f"Received shutdown request from {request.remote_addr}. Stopping services...")
+                if self.log_queue is not None:
+                    self.log_queue.flush(timeout=DEFAULT_LOG_FLUSH_TIMEOUT)
                 self.socketio.stop()
                 return 'Services shutting down...\n', 200
             else:
@@ -324,26 +733,96 @@ class FlaskApp:
             self.stop()
 
     def render_template(self, template:str, page=None, **kwargs):
-        ''' Render the requested template.  Automatically inserts base page data '''
-        # get function name of the calling function
-        stack = inspect.stack()
-        for x in range(len(stack)):
-            if stack[x].function == 'render_template':
-                break
-        if x + 1 < len(stack):
-            calling_func = stack[x+1].function
-        if os.path.exists(os.path.join(self.site_data['templates_path'], template)):
-            return render_template(template, site=self.site_data, page=self.web_pages[calling_func].get('data', {}) if page is None else page, **kwargs)
-        elif os.path.exists(os.path.join(self.site_data['templates_path'], '_app', 'templates', template)):
-            return render_template(os.path.join('_app', template), site=self.site_data, page=self.web_pages[calling_func].get('data', {}) if page is None else page, **kwargs)
-        return render_template(os.path.join('_base_template', 'templates', template), site=self.site_data, page=self.web_pages[calling_func].get('data', {}) if page is None else page, **kwargs)
+        ''' Render the requested template.  Automatically inserts base page data for the page handling the request '''
+        return render_template(self.resolve_template(template), site=self.site_data, page=self._page_data() if page is None else page, **kwargs)
+
+    def render_template_stream(self, template:str, page=None, **kwargs):
+        ''' Render the requested template as a streamed response (sent as it is generated instead of building the whole page in memory).
+            Uses the same template lookup and base page data as render_template '''
+        return self.app.response_class(stream_template(self.resolve_template(template), site=self.site_data, page=self._page_data() if page is None else page, **kwargs))
+
+    def _page_data(self) -> dict:
+        ''' Return the configured 'data' for the page handling the current request '''
+        return self.web_pages.get(g.get('flask_app_page', None), {}).get('data', {}) if has_app_context() else {}
+
+    def resolve_template(self, template:str) -> str:
+        ''' Return the template name relative to the templates folder.  Local templates override app templates, which override the base template.
+            Lookups are cached until invalidate_templates() is called, or not cached at all if template auto reload is enabled '''
+        template_path = self._template_paths.get(template, None)
+        if template_path is None:
+            if os.path.exists(os.path.join(self.site_data['templates_path'], template)):
+                template_path = template
+            elif os.path.exists(os.path.join(self.site_data['templates_path'], '_app', 'templates', template)):
+                template_path = os.path.join('_app', 'templates', template)
+            else:
+                template_path = os.path.join('_base_template', 'templates', template)
+            if not (self.app is not None and self.app.jinja_env.auto_reload):
+                self._template_paths[template] = template_path
+        return template_path
+
+    def list_templates(self) -> list:
+        ''' Return the names of all templates in the templates folder and the templates folders of the base template and app '''
+        templates = []
+        for search_path, prefix in ((self.site_data['templates_path'], ''),
+                                    (os.path.join(self.site_data['templates_path'], '_base_template', 'templates'), os.path.join('_base_template', 'templates')),
+                                    (os.path.join(self.site_data['templates_path'], '_app', 'templates'), os.path.join('_app', 'templates'))):
+            for root, dirs, files in os.walk(search_path, followlinks=True):
+                if root == self.site_data['templates_path']:
+                    # the base template and app are searched separately
+                    dirs[:] = [x for x in dirs if x not in ('_base_template', '_app')]
+                for file_name in files:
+                    if file_name.endswith(TEMPLATE_EXTENSIONS):
+                        templates.append(os.path.join(prefix, os.path.relpath(os.path.join(root, file_name), search_path)))
+        return templates
+
+    def precompile_templates(self) -> dict:
+        ''' Compile all templates (loading them into the Jinja cache and the bytecode cache if configured).  Returns a dict of template name -> compile seconds '''
+        compile_times = {}
+        for template in self.list_templates():
+            start = perf_counter()
+            try:
+                self.app.jinja_env.get_template(template)
+            except TemplateError as e:
+                self.app_logger.error(f"{self.info_str}: Unable to compile template {template}: {e.__class__.__name__}: {e}")
+                continue
+            compile_times[template] = perf_counter() - start
+            self.app_logger.debug(f"{self.info_str}: Compiled template {template} in {compile_times[template] * 1000:.1f}ms")
+        self.app_logger.info(f"{self.info_str}: Compiled {len(compile_times)} templates in {sum(compile_times.values()) * 1000:.1f}ms")
+        return compile_times
+
+    def invalidate_templates(self):
+        ''' Clear the cached template locations (call after adding or removing templates) '''
+        self._template_paths = {}
 
     def return_error(self, code:int=404):
         ''' Return an error code '''
         abort(code)
 
     def stop(self):
-        pass
+        ''' Stop background services '''
+        self.stop_static_watcher()
+        if self.user_controller is not None:
+            self.user_controller.close()
+        if self.session_store is not None:
+            self.session_store.close()
+            self.session_store = None
+        if self.log_queue is not None:
+            # last, so messages logged while stopping are written
+            self.log_queue.stop()
+            self.log_queue = None
+        self._patch_access_log(False)
+
+    def _patch_access_log(self, enable:bool):
+        ''' Send the gevent access log through the werkzeug logger (so it is queued) or restore gevent's own access log '''
+        if not enable and f"{__package__}.logging_patch" not in sys.modules:
+            # never patched
+            return
+        try:
+            from .logging_patch import patch_wsgihandler_logger
+        except ImportError:
+            # gevent not installed
+            return
+        patch_wsgihandler_logger(enable)
 
     def web_home(self):
         return "<body>test123</body>", 200
@@ -354,8 +833,46 @@ class FlaskApp:
 
     def web_static_file(self):
         ''' Return a static file '''
-        file_name = request.url_rule.rule.rsplit('/', 1)[-1]
-        return send_file(self.static_pages[request.url_rule.rule], download_name=file_name, as_attachment=bool(safe_string(request.args.get('download', False))))
+        if request.url_rule.rule not in self.static_pages:
+            # removed since the route was added
+            abort(404)
+        return self.send_static_file(request.url_rule.rule)
+
+    def web_static_index(self, static_path:str):
+        ''' Return a static file from the static_pages index (catch all static routing) '''
+        route = '/' + static_path
+        if route not in self.static_pages:
+            abort(404)
+        return self.send_static_file(route)
+
+    def send_static_file(self, route:str):
+        ''' Return the static file registered for a route.  Served from the static cache (with conditional GET support) if enabled '''
+        if route in self._static_fingerprint_routes and not self._static_fingerprint_current(route):
+            # the file changed since the fingerprint was taken, never serve new content under the old (immutable) fingerprint
+            base_route = self._static_fingerprint_routes[route][0]
+            return redirect(base_route + ('?' + request.query_string.decode() if request.query_string else ''))
+        file_name = route.rsplit('/', 1)[-1]
+        as_attachment = bool(safe_string(request.args.get('download', False)))
+        if self.static_cache is None:
+            response = send_file(self.static_pages[route], download_name=file_name, as_attachment=as_attachment)
+            if route in self._static_fingerprint_routes:
+                response.headers['Cache-Control'] = STATIC_FINGERPRINT_CACHE_CONTROL
+            return response
+        try:
+            entry, encoding = self.static_cache.lookup_encoded(self.static_pages[route], request.accept_encodings)
+        except OSError:
+            abort(404)
+        # files larger than the cache file size threshold are streamed from disk
+        response = send_static_entry(request, self.app.response_class, entry)
+        response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline', filename=file_name)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        if self.static_cache.variants(self.static_pages[route]):
+            response.vary.add('Accept-Encoding')
+        cache_control = STATIC_FINGERPRINT_CACHE_CONTROL if route in self._static_fingerprint_routes else self.static_cache.cache_control(route)
+        if cache_control is not None:
+            response.headers['Cache-Control'] = cache_control
+        return response
 
     def request_args_safe(self, *args) -> bool:
         ''' Checks that all request arguments are safe strings.  Non-alphanumeric characters that are accepted can be passed as arguments '''
@@ -379,6 +896,24 @@ def get_all_files(path:str, include_subdir:bool):
     return file_list
 
 
+def _request_session():
+    ''' Return the session of the current request without marking it accessed (Flask 3.1.3+ marks it on every use of the proxy) '''
+    request_session = getattr(request_ctx, '_session', None)
+    return request_session if request_session is not None else request_ctx.session
+
+
+def fingerprint_route(route:str, file_hash:str) -> str:
+    ''' Return the fingerprinted route for a static route and the content hash of its file (i.e. /js/app.3f9a1c4d2e.js) '''
+    route_base, route_ext = os.path.splitext(route)
+    return f"{route_base}.{file_hash[:STATIC_FINGERPRINT_LENGTH]}{route_ext}"
+
+
+def without_precompressed(files:list) -> list:
+    ''' Return the files without the precompressed siblings (.gz / .br) of other files in the list '''
+    file_set = set(files)
+    return [file for file in files if not any(file.endswith(suffix) and file[:-len(suffix)] in file_set for _, suffix in PRECOMPRESSED_VARIANTS)]
+
+
 def is_safe_url(target):
     ref_url = urlparse(request.host_url)
     test_url = urlparse(urljoin(request.host_url, target))
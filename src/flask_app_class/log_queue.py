@@ -0,0 +1,152 @@
+'''
+Queued logging - records from the app, werkzeug and gevent access loggers are put on a bounded queue and written by a background
+thread, so a slow disk or stdout pipe does not add to the request latency:
+    "log_queue": {
+        "max_size": 10000,      # records waiting to be written
+        "overflow": "drop",     # 'drop' new records while the queue is full (counted) or 'block' the logging thread until there is room
+        "block_timeout": null,  # with 'block', seconds to wait before dropping the record (null waits forever)
+        "loggers": []           # names of additional loggers to queue
+    }
+Only the message is merged on the logging thread, formatting (including tracebacks) and writing happens on the listener thread.
+With 'block' under gevent without monkey patching a full queue stalls the hub, use 'drop' there.
+'''
+
+import copy
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue, Full
+from threading import Lock
+from time import monotonic
+
+DEFAULT_LOG_QUEUE_SIZE = 10000
+LOG_QUEUE_DROP = 'drop'
+LOG_QUEUE_BLOCK = 'block'
+LOG_QUEUE_OVERFLOW = (LOG_QUEUE_DROP, LOG_QUEUE_BLOCK)
+
+
+class _LoggerQueueHandler(QueueHandler):
+    ''' Replaces the handlers of one logger.  Records are queued along with the logger's original handlers so a single listener
+        thread can write the records of every queued logger '''
+    def __init__(self, log_queue, handlers:list):
+        super().__init__(log_queue.queue)
+        self.log_queue = log_queue
+        self.handlers = tuple(handlers)
+        # records no handler would write are not queued
+        self.setLevel(min(handler.level for handler in self.handlers))
+
+    def prepare(self, record):
+        ''' Merge the message args now (they may be changed by the caller before the record is written), the rest of the formatting
+            is left to the listener '''
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self.log_queue.overflow == LOG_QUEUE_BLOCK:
+            try:
+                self.queue.put((self.handlers, record), timeout=self.log_queue.block_timeout)
+                return
+            except Full:
+                pass
+        else:
+            try:
+                self.queue.put_nowait((self.handlers, record))
+                return
+            except Full:
+                pass
+        self.log_queue.dropped(record)
+
+
+class _LogQueueListener(QueueListener):
+    ''' Writes each record to the handlers queued with it '''
+    def handle(self, record):
+        handlers, record = record
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def enqueue_sentinel(self):
+        # wait for room rather than losing the sentinel on a full queue
+        self.queue.put(self._sentinel)
+
+
+class LogQueue:
+    ''' Moves the handlers of a set of loggers behind a bounded queue written by a background thread.  stop() writes the remaining
+        records and puts the original handlers back '''
+    def __init__(self, loggers:list, max_size:int=DEFAULT_LOG_QUEUE_SIZE, overflow:str=LOG_QUEUE_DROP, block_timeout:float|None=None):
+        if overflow not in LOG_QUEUE_OVERFLOW:
+            raise ValueError(f"log_queue overflow must be one of {LOG_QUEUE_OVERFLOW}. Got: {overflow}")
+        self.loggers = [logging.getLogger(logger) if isinstance(logger, str) else logger for logger in loggers]
+        self.max_size = max_size
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.queue = Queue(maxsize=max_size)
+        self._listener = None
+        self._handlers = {}
+        self._lock = Lock()
+        self.counters = {'dropped': 0}
+
+    @classmethod
+    def from_config(cls, loggers:list, config:dict):
+        ''' Build a log queue from a 'log_queue' config block, the 'loggers' in the config are added to loggers '''
+        return cls(loggers + config.get('loggers', []), max_size=config.get('max_size', DEFAULT_LOG_QUEUE_SIZE),
+                   overflow=config.get('overflow', LOG_QUEUE_DROP), block_timeout=config.get('block_timeout', None))
+
+    @property
+    def running(self) -> bool:
+        return self._listener is not None
+
+    @property
+    def stats(self) -> dict:
+        return dict(self.counters, queued=self.queue.qsize(), max_size=self.max_size, overflow=self.overflow)
+
+    def dropped(self, record):
+        ''' Called by the queue handlers for a record that did not fit in the queue '''
+        with self._lock:
+            self.counters['dropped'] += 1
+
+    def start(self):
+        ''' Replace the handlers of each logger with a queue handler and start the listener.  Loggers without handlers are skipped,
+            their records propagate to a parent logger '''
+        if self.running:
+            return
+        for logger in self.loggers:
+            if logger in self._handlers or not logger.handlers:
+                continue
+            self._handlers[logger] = list(logger.handlers)
+            queue_handler = _LoggerQueueHandler(self, logger.handlers)
+            for handler in self._handlers[logger]:
+                logger.removeHandler(handler)
+            logger.addHandler(queue_handler)
+        self._listener = _LogQueueListener(self.queue)
+        self._listener.start()
+
+    def flush(self, timeout:float|None=None) -> bool:
+        ''' Wait until the queued records are written and flush the handlers.  Returns False if the timeout expired first '''
+        end = None if timeout is None else monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks and self.running:
+                remaining = None if end is None else end - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        for handlers in self._handlers.values():
+            for handler in handlers:
+                handler.flush()
+        return True
+
+    def stop(self):
+        ''' Write the remaining records, stop the listener and put the original handlers back '''
+        if not self.running:
+            return
+        self._listener.stop()
+        self._listener = None
+        for logger, handlers in self._handlers.items():
+            for handler in list(logger.handlers):
+                if isinstance(handler, _LoggerQueueHandler) and handler.log_queue is self:
+                    logger.removeHandler(handler)
+            for handler in handlers:
+                logger.addHandler(handler)
+                handler.flush()
+        self._handlers = {}
@@ -1,3 +1,5 @@
+import logging
+from gevent import pywsgi
 from gevent.pywsgi import WSGIHandler
 from datetime import datetime
 
@@ -28,3 +30,17 @@ def patched_format_request(self):
 
 def patch_wsgihandler():
     WSGIHandler.format_request = patched_format_request
+
+_original_log_request = WSGIHandler.log_request
+_NoopLog = getattr(pywsgi, '_NoopLog', ())
+ACCESS_LOGGER_NAME = 'werkzeug'
+
+def patched_log_request(self):
+    # the server was started with log=None (log_output disabled)
+    if isinstance(self.server.log, _NoopLog):
+        return
+    logging.getLogger(ACCESS_LOGGER_NAME).info(self.format_request())
+
+def patch_wsgihandler_logger(enable=True):
+    ''' Send the gevent access log to the werkzeug logger (and its handlers / web_log_filter) instead of writing to stderr '''
+    WSGIHandler.log_request = patched_log_request if enable else _original_log_request
@@ -0,0 +1,124 @@
+'''
+Login throttling for the user controllers.  Token buckets per username and per client address (plus an optional global bucket
+to shed load before it reaches the authentication backend) with a progressive lockout after repeated failures:
+    "login_throttle": {
+        "username": {"burst": 5, "per_minute": 10},
+        "ip": {"burst": 20, "per_minute": 60},
+        "global": {"burst": 200, "per_minute": 6000},   # optional
+        "backoff": {"after": 5, "base": 1, "max": 300}, # lockout of base * 2^n seconds after 'after' consecutive failures
+        "max_entries": 100000                           # per bucket type, least recently used entries are dropped
+    }
+'''
+
+from threading import Lock
+from time import monotonic
+from .cache import LRUCache
+
+DEFAULT_THROTTLE_ENTRIES = 100000
+DEFAULT_USERNAME_BUCKET = {'burst': 5, 'per_minute': 10}
+DEFAULT_IP_BUCKET = {'burst': 20, 'per_minute': 60}
+DEFAULT_BACKOFF = {'after': 5, 'base': 1, 'max': 300}
+
+
+class _Bucket:
+    ''' Token bucket with the consecutive failure count and lockout of a single key '''
+    __slots__ = ('tokens', 'updated', 'failures', 'blocked_until')
+
+    def __init__(self, tokens:float, now:float):
+        self.tokens = tokens
+        self.updated = now
+        self.failures = 0
+        self.blocked_until = 0.0
+
+
+class LoginThrottle:
+    ''' Decides if a login attempt may reach the authentication backend.  Memory is bounded by max_entries buckets per key type '''
+    def __init__(self, username:dict|None=None, ip:dict|None=None, global_limit:dict|None=None, backoff:dict|None=None,
+                 max_entries:int=DEFAULT_THROTTLE_ENTRIES):
+        self._limits = {'username': username if username is not None else DEFAULT_USERNAME_BUCKET,
+                        'ip': ip if ip is not None else DEFAULT_IP_BUCKET}
+        if global_limit is not None:
+            self._limits['global'] = global_limit
+        self.backoff = dict(DEFAULT_BACKOFF, **(backoff if backoff is not None else {}))
+        self._buckets = {kind: LRUCache(max_entries=max_entries) for kind in self._limits}
+        self._lock = Lock()
+        self.counters = {'allowed': 0, 'throttled': 0, 'locked_out': 0}
+
+    @classmethod
+    def from_config(cls, config:dict):
+        ''' Build a throttle from a 'login_throttle' config block '''
+        return cls(username=config.get('username', None), ip=config.get('ip', None), global_limit=config.get('global', None),
+                   backoff=config.get('backoff', None), max_entries=config.get('max_entries', DEFAULT_THROTTLE_ENTRIES))
+
+    @property
+    def stats(self) -> dict:
+        return dict(self.counters, **{f"{kind}_entries": len(buckets) for kind, buckets in self._buckets.items()})
+
+    def check(self, username:str|None, remote_addr:str|None) -> float:
+        ''' Take a token for a login attempt.  Returns 0 if the attempt is allowed, otherwise the seconds until it may be retried '''
+        now = monotonic()
+        with self._lock:
+            buckets = [(kind, self._bucket(kind, key, now)) for kind, key in self._keys(username, remote_addr)]
+            retry_after = max((bucket.blocked_until - now for _, bucket in buckets), default=0)
+            if retry_after > 0:
+                self.counters['locked_out'] += 1
+                return retry_after
+            for kind, bucket in buckets:
+                rate = self._limits[kind]['per_minute'] / 60
+                bucket.tokens = min(bucket.tokens + (now - bucket.updated) * rate, self._limits[kind]['burst'])
+                bucket.updated = now
+                if bucket.tokens < 1:
+                    retry_after = max(retry_after, (1 - bucket.tokens) / rate if rate > 0 else self.backoff['max'])
+            if retry_after > 0:
+                self.counters['throttled'] += 1
+                return retry_after
+            for _, bucket in buckets:
+                bucket.tokens -= 1
+            self.counters['allowed'] += 1
+        return 0
+
+    def result(self, username:str|None, remote_addr:str|None, success:bool):
+        ''' Record the outcome of an attempt.  Failures beyond backoff 'after' lock the username and address out for
+            base * 2^n seconds (up to max), a success clears the username and address '''
+        now = monotonic()
+        with self._lock:
+            for kind, key in self._keys(username, remote_addr):
+                if kind == 'global':
+                    continue
+                bucket = self._bucket(kind, key, now)
+                if success:
+                    bucket.failures = 0
+                    bucket.blocked_until = 0.0
+                    continue
+                bucket.failures += 1
+                excess = bucket.failures - self.backoff['after']
+                if excess >= 0:
+                    bucket.blocked_until = now + min(self.backoff['base'] * 2 ** min(excess, 32), self.backoff['max'])
+
+    def reset(self, username:str|None=None, remote_addr:str|None=None):
+        ''' Clear the buckets for a username and/or address (or everything if neither is given) '''
+        with self._lock:
+            if username is None and remote_addr is None:
+                for buckets in self._buckets.values():
+                    buckets.clear()
+                return
+            for kind, key in self._keys(username, remote_addr):
+                if kind != 'global':
+                    self._buckets[kind].pop(key)
+
+    def _keys(self, username:str|None, remote_addr:str|None) -> list:
+        keys = []
+        if username is not None:
+            keys.append(('username', username))
+        if remote_addr is not None:
+            keys.append(('ip', remote_addr))
+        if 'global' in self._limits:
+            keys.append(('global', None))
+        return keys
+
+    def _bucket(self, kind:str, key, now:float) -> _Bucket:
+        bucket = self._buckets[kind].get(key, None, count=False)
+        if bucket is None:
+            bucket = _Bucket(self._limits[kind]['burst'], now)
+            self._buckets[kind].set(key, bucket)
+        return bucket
@@ -0,0 +1,302 @@
+'''
+Load testing for the RADIUS client on localhost.
+
+RadiusTestServer is an in-process UDP responder that stands in for a RADIUS server with configurable latency, packet loss and
+accept / reject / challenge ratios.  run_load() fires concurrent authentications through the real client (Radius or
+RadiusUserController) and reports throughput and latency percentiles.
+
+    python -m flask_app_class.radius_loadtest --requests 5000 --concurrency 50 --latency 0.02 --drop 0.01
+'''
+
+import sys
+import heapq
+import random
+import socket
+import logging
+import argparse
+from math import ceil
+from hashlib import md5
+from threading import Thread, Condition, Lock
+from time import monotonic, perf_counter
+from typing import Callable
+from ._radius import Radius, Message, Attributes, ChallengeResponse, NoResponse, PACKET_MAX, CODE_ACCESS_REQUEST, CODE_ACCESS_ACCEPT, \
+    CODE_ACCESS_REJECT, CODE_ACCESS_CHALLENGE, CODE_STATUS_SERVER, CODE_ACCOUNTING_REQUEST, CODE_ACCOUNTING_RESPONSE, ATTR_MESSAGE_AUTHENTICATOR
+
+ACCEPT = 'accept'
+REJECT = 'reject'
+CHALLENGE = 'challenge'
+TIMEOUT = 'timeout'
+ERROR = 'error'
+
+DEFAULT_LOAD_REQUESTS = 1000
+DEFAULT_LOAD_CONCURRENCY = 20
+DEFAULT_TEST_SECRET = 'loadtest'
+
+
+class RadiusTestServer:
+    ''' Local UDP RADIUS responder.  Replies are chosen at random using the accept / reject / challenge weights and delayed by
+        latency (+/- jitter) seconds.  drop is the fraction of requests that are silently discarded.
+        Replies are signed with the shared secret so they pass the client's verification.  Accounting-Requests with a valid
+        authenticator are answered with an Accounting-Response and kept in accounting_records.
+        accept_attributes are added to every Access-Accept, i.e. {"Class": b"admins"} '''
+    def __init__(self, secret:str=DEFAULT_TEST_SECRET, host:str='127.0.0.1', port:int=0, latency:float=0.0, jitter:float=0.0,
+                 drop:float=0.0, accept:float=1.0, reject:float=0.0, challenge:float=0.0, seed:int|None=None,
+                 accept_attributes:dict|None=None):
+        self.secret = secret.encode('utf-8') if isinstance(secret, str) else secret
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.accept_attributes = accept_attributes if accept_attributes is not None else {}
+        self.weights = {CODE_ACCESS_ACCEPT: accept, CODE_ACCESS_REJECT: reject, CODE_ACCESS_CHALLENGE: challenge}
+        if sum(self.weights.values()) <= 0:
+            raise ValueError('At least one of accept, reject or challenge must be greater than 0')
+        self._random = random.Random(seed)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((host, port))
+        self._sock.settimeout(0.5)
+        self._queue = [] # heap of (due, sequence, packet, addr)
+        self._queue_ready = Condition()
+        self._sequence = 0
+        self._lock = Lock()
+        self._threads = []
+        self._running = False
+        self.accounting_records = []
+        self.counters = {'received': 0, 'dropped': 0, 'invalid': 0, ACCEPT: 0, REJECT: 0, CHALLENGE: 0, 'status': 0, 'accounting': 0}
+
+    @property
+    def host(self) -> str:
+        return self._sock.getsockname()[0]
+
+    @property
+    def port(self) -> int:
+        return self._sock.getsockname()[1]
+
+    @property
+    def is_running(self) -> bool:
+        return self._running
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        ''' Start the receive and reply threads '''
+        if self._running:
+            return
+        self._running = True
+        self._threads = [Thread(target=self._receive, name='RadiusTestServer-receive', daemon=True),
+                         Thread(target=self._reply, name='RadiusTestServer-reply', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        ''' Stop the server and close the socket '''
+        self._running = False
+        with self._queue_ready:
+            self._queue_ready.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._threads = []
+        self._sock.close()
+
+    def _receive(self):
+        ''' Receive requests, build the reply and queue it until it is due '''
+        while self._running:
+            try:
+                data, addr = self._sock.recvfrom(PACKET_MAX)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            with self._lock:
+                self.counters['received'] += 1
+                if self._random.random() < self.drop:
+                    self.counters['dropped'] += 1
+                    continue
+                delay = max(self.latency + self._random.uniform(-self.jitter, self.jitter), 0)
+            packet = self.response(data)
+            if packet is None:
+                continue
+            with self._queue_ready:
+                self._sequence += 1
+                heapq.heappush(self._queue, (monotonic() + delay, self._sequence, packet, addr))
+                self._queue_ready.notify()
+
+    def _reply(self):
+        ''' Send queued replies when they are due '''
+        while self._running:
+            with self._queue_ready:
+                while self._running and (not self._queue or self._queue[0][0] > monotonic()):
+                    self._queue_ready.wait(self._queue[0][0] - monotonic() if self._queue else None)
+                if not self._running:
+                    break
+                _, _, packet, addr = heapq.heappop(self._queue)
+            try:
+                self._sock.sendto(packet, addr)
+            except OSError:
+                pass
+
+    def response(self, data:bytes) -> bytes|None:
+        ''' Return the signed reply for a request (None if the request is not valid) '''
+        try:
+            request = Message.unpack(self.secret, data)
+        except Exception:
+            with self._lock:
+                self.counters['invalid'] += 1
+            return None
+        attributes = Attributes()
+        if request.code == CODE_STATUS_SERVER:
+            code, outcome = CODE_ACCESS_ACCEPT, 'status'
+        elif request.code == CODE_ACCESS_REQUEST:
+            with self._lock:
+                code = self._random.choices(list(self.weights), weights=list(self.weights.values()))[0]
+            outcome = {CODE_ACCESS_ACCEPT: ACCEPT, CODE_ACCESS_REJECT: REJECT, CODE_ACCESS_CHALLENGE: CHALLENGE}[code]
+            if code == CODE_ACCESS_ACCEPT:
+                attributes.update(self.accept_attributes)
+            elif code == CODE_ACCESS_CHALLENGE:
+                attributes['Reply-Message'] = b'Enter the code sent to your device'
+                attributes['State'] = self._random.randbytes(8)
+        elif request.code == CODE_ACCOUNTING_REQUEST and \
+                md5(data[:4] + b'\0' * 16 + data[20:] + self.secret).digest() == request.authenticator:
+            code, outcome = CODE_ACCOUNTING_RESPONSE, 'accounting'
+            with self._lock:
+                self.accounting_records.append(request.attributes)
+        else:
+            with self._lock:
+                self.counters['invalid'] += 1
+            return None
+        with self._lock:
+            self.counters[outcome] += 1
+        if ATTR_MESSAGE_AUTHENTICATOR in request.attributes:
+            attributes['Message-Authenticator'] = b'\0' * 16
+        # Response Authenticator (RFC 2865 3): MD5(Code + ID + Length + Request Authenticator + Attributes + Secret)
+        reply = bytearray(Message(self.secret, code, id=request.id, authenticator=request.authenticator, attributes=attributes).pack())
+        reply[4:20] = md5(bytes(reply) + self.secret).digest()
+        return bytes(reply)
+
+
+class LoadResult:
+    ''' Outcome counts and latencies (seconds) of a load run '''
+    def __init__(self, latencies:list, outcomes:dict, elapsed:float):
+        self.latencies = sorted(latencies)
+        self.outcomes = outcomes
+        self.elapsed = elapsed
+
+    @property
+    def requests(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def throughput(self) -> float:
+        ''' Completed requests per second '''
+        return self.requests / self.elapsed if self.elapsed > 0 else 0.0
+
+    def percentile(self, percent:float) -> float|None:
+        ''' Return a latency percentile (nearest rank) in seconds '''
+        if not self.latencies:
+            return None
+        return self.latencies[min(max(ceil(percent / 100 * len(self.latencies)) - 1, 0), len(self.latencies) - 1)]
+
+    def summary(self) -> dict:
+        ''' Returns the results as a dict (latencies in milliseconds) '''
+        return {'requests': self.requests, 'elapsed': round(self.elapsed, 3), 'throughput': round(self.throughput, 1),
+                'outcomes': dict(self.outcomes),
+                **{f"p{percent}_ms": round(self.percentile(percent) * 1000, 2) if self.latencies else None for percent in (50, 95, 99)},
+                'max_ms': round(self.latencies[-1] * 1000, 2) if self.latencies else None}
+
+    def __str__(self):
+        summary = self.summary()
+        return f"{summary['requests']} requests in {summary['elapsed']}s: {summary['throughput']} req/s, " \
+               f"p50 {summary['p50_ms']}ms, p95 {summary['p95_ms']}ms, p99 {summary['p99_ms']}ms, max {summary['max_ms']}ms, " \
+               f"outcomes {summary['outcomes']}"
+
+
+def classify(result) -> str:
+    ''' Map the return value of Radius.authenticate / RadiusUserController.authenticate_user to an outcome '''
+    return ACCEPT if result else REJECT
+
+
+def run_load(authenticate:Callable, requests:int=DEFAULT_LOAD_REQUESTS, concurrency:int=DEFAULT_LOAD_CONCURRENCY,
+             usernames:list|None=None, password:str='password') -> LoadResult:
+    ''' Call authenticate(username, password) requests times from concurrency threads.
+        Usernames are used in turn (default a distinct username per request so logins are not coalesced or cached) '''
+    latencies, outcomes = [], {}
+    lock = Lock()
+    remaining = iter(range(requests))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(remaining, None)
+            if i is None:
+                return
+            username = usernames[i % len(usernames)] if usernames else f"user{i}"
+            start = perf_counter()
+            try:
+                outcome = classify(authenticate(username, password))
+            except ChallengeResponse:
+                outcome = CHALLENGE
+            except NoResponse:
+                outcome = TIMEOUT
+            except Exception:
+                outcome = ERROR
+            latency = perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    threads = [Thread(target=worker, name=f"RadiusLoad-{i}", daemon=True) for i in range(max(min(concurrency, requests), 1))]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return LoadResult(latencies, outcomes, perf_counter() - start)
+
+
+def main(argv:list|None=None):
+    parser = argparse.ArgumentParser(description="Load test the RADIUS client against a local stand-in RADIUS server.")
+    parser.add_argument("--requests", type=int, default=DEFAULT_LOAD_REQUESTS, help='Number of authentications to send.')
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_LOAD_CONCURRENCY, help='Number of concurrent clients.')
+    parser.add_argument("--client", choices=('radius', 'controller'), default='controller',
+                        help='Authenticate with Radius directly or through RadiusUserController.')
+    parser.add_argument("--secret", type=str, default=DEFAULT_TEST_SECRET, help='Shared secret.')
+    parser.add_argument("--latency", type=float, default=0.0, help='Server reply latency in seconds.')
+    parser.add_argument("--jitter", type=float, default=0.0, help='Random +/- variation of the latency in seconds.')
+    parser.add_argument("--drop", type=float, default=0.0, help='Fraction of requests the server drops.')
+    parser.add_argument("--accept", type=float, default=1.0, help='Weight of Access-Accept replies.')
+    parser.add_argument("--reject", type=float, default=0.0, help='Weight of Access-Reject replies.')
+    parser.add_argument("--challenge", type=float, default=0.0, help='Weight of Access-Challenge replies.')
+    parser.add_argument("--retries", type=int, default=3, help='Client retries.')
+    parser.add_argument("--timeout", type=float, default=1.0, help='Client timeout (upper bound with adaptive timeouts).')
+    parser.add_argument("--no-persistent", dest='persistent', action='store_false', help='Use a new socket for each request.')
+    parser.add_argument("--no-adaptive", dest='adaptive', action='store_false', help='Use a fixed retransmission timeout.')
+    parser.add_argument("--users", type=int, default=0, help='Number of distinct usernames (0 for a new username per request).')
+    parser.add_argument("--seed", type=int, default=None, help='Random seed for the server.')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+    with RadiusTestServer(secret=args.secret, latency=args.latency, jitter=args.jitter, drop=args.drop, accept=args.accept,
+                          reject=args.reject, challenge=args.challenge, seed=args.seed) as server:
+        if args.client == 'radius':
+            radius = Radius(args.secret, host=server.host, port=server.port, retries=args.retries, timeout=args.timeout,
+                            persistent=args.persistent, adaptive=args.adaptive)
+            authenticate = radius.authenticate
+        else:
+            from .user_radius import RadiusUserController
+            controller = RadiusUserController(host=server.host, shared_secret=args.secret, port=server.port, retries=args.retries,
+                                              timeout=args.timeout, persistent=args.persistent, adaptive_timeout=args.adaptive,
+                                              logger=logging.getLogger('radius_loadtest'))
+            authenticate = controller.authenticate_user
+        result = run_load(authenticate, requests=args.requests, concurrency=args.concurrency,
+                          usernames=[f"user{i}" for i in range(args.users)] if args.users else None)
+        print(result)
+        print(f"server: {server.counters}")
+    return 0 if result.outcomes.get(ERROR, 0) == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+'''
+In-process cache of rendered page responses and template fragments for FlaskApp pages.
+Pages opt in with a 'cache' block in their web_pages / api_pages config:
+    "cache": {
+        "ttl": 60,                          # seconds
+        "vary_query": ["page", "sort"],     # query args that are part of the key (true for all query args)
+        "vary_user": true,                  # cache per logged in user (required on pages with 'roles')
+        "vary_headers": ["Accept-Language"] # request headers that are part of the key
+    }
+Responses carry a Vary header for vary_headers (and Cookie with vary_user) so downstream caches keep the variants apart.
+'''
+
+import hashlib
+from threading import Lock
+from .cache import LRUCache
+
+DEFAULT_RESPONSE_CACHE_ENTRIES = 1024
+DEFAULT_RESPONSE_CACHE_BYTES = 32 * 1024 * 1024
+DEFAULT_RESPONSE_CACHE_TTL = 60
+
+
+class CachedResponse:
+    ''' A response body with the status, headers and ETag it was returned with '''
+    __slots__ = ('body', 'status', 'headers', 'etag')
+
+    def __init__(self, body:bytes, status:int, headers:list, etag:str):
+        self.body = body
+        self.status = status
+        self.headers = headers
+        self.etag = etag
+
+
+class ResponseCache:
+    ''' LRU cache (entry count and byte budget) of page responses and fragments with hit / miss counters for each page '''
+    def __init__(self, max_entries:int=DEFAULT_RESPONSE_CACHE_ENTRIES, max_bytes:int=DEFAULT_RESPONSE_CACHE_BYTES):
+        self._cache = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        self._lock = Lock()
+        self.page_stats = {}
+
+    @property
+    def stats(self) -> dict:
+        ''' Returns the overall cache counters with the hit / miss counts for each page '''
+        return dict(self._cache.stats, pages={page: dict(counters) for page, counters in self.page_stats.items()})
+
+    @staticmethod
+    def request_key(page:str, cache_config:dict, request, user_id=None) -> tuple:
+        ''' Build the cache key for a page from the request and the vary settings of the page '''
+        vary_query = cache_config.get('vary_query', [])
+        if vary_query is True:
+            query = tuple(sorted(request.args.items(multi=True)))
+        else:
+            query = tuple((arg, tuple(request.args.getlist(arg))) for arg in vary_query)
+        headers = tuple(request.headers.get(header, None) for header in cache_config.get('vary_headers', []))
+        return (page, request.method == 'HEAD', request.path, query, headers, user_id if cache_config.get('vary_user', False) else None)
+
+    def get(self, page:str, key:tuple) -> CachedResponse|None:
+        ''' Return a cached response and update the counters for the page '''
+        entry = self._cache.get(key, None)
+        with self._lock:
+            counters = self.page_stats.setdefault(page, {'hits': 0, 'misses': 0})
+            counters['hits' if entry is not None else 'misses'] += 1
+        return entry
+
+    def set(self, key:tuple, body:bytes, status:int, headers:list, ttl:float=DEFAULT_RESPONSE_CACHE_TTL) -> CachedResponse:
+        ''' Store a response.  The ETag is calculated from the body '''
+        entry = CachedResponse(body, status, headers, hashlib.sha1(body).hexdigest())
+        self._cache.set(key, entry, size=len(body), ttl=ttl)
+        return entry
+
+    def get_fragment(self, key:str):
+        ''' Return a cached fragment (None if not cached) '''
+        return self._cache.get(('fragment', key), None)
+
+    def set_fragment(self, key:str, value:str, ttl:float=DEFAULT_RESPONSE_CACHE_TTL):
+        ''' Store a rendered fragment '''
+        self._cache.set(('fragment', key), value, size=len(value), ttl=ttl)
+
+    def invalidate(self, page:str|None=None, fragment:str|None=None) -> int:
+        ''' Remove the cached responses for a page, a single fragment, or everything if neither is given.  Returns the number of entries removed '''
+        if page is None and fragment is None:
+            return self._cache.invalidate()
+        return self._cache.invalidate(lambda key: (page is not None and key[0] == page) or (fragment is not None and key == ('fragment', fragment)))
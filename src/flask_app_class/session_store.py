@@ -0,0 +1,304 @@
+'''
+Server side sessions for FlaskApp.  The session cookie only carries an opaque random session id, the session data is held in a
+session store.  Configured with a 'session' block in the config:
+    "session": {
+        "store": "memory",          # "memory" (per process LRU) or "mmap" (file shared by all workers on the host, survives restarts)
+        "ttl": 86400,               # seconds a session is kept after its last change (permanent sessions use PERMANENT_SESSION_LIFETIME)
+        "max_entries": 65536,       # memory store
+        "file": ".flask_sessions",  # mmap store
+        "slots": 16384,             # mmap store - number of sessions the file can hold
+        "slot_size": 2048           # mmap store - bytes per session (including a 44 byte header)
+    }
+'''
+
+import os
+import re
+import mmap
+import struct
+import secrets
+import logging
+from threading import Lock
+from time import time
+from zlib import crc32
+from flask.sessions import SessionInterface, SecureCookieSession
+from flask.json.tag import TaggedJSONSerializer
+from .cache import LRUCache
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MEMORY_STORE = 'memory'
+MMAP_STORE = 'mmap'
+DEFAULT_SESSION_TTL = 86400
+DEFAULT_SESSION_ENTRIES = 65536
+DEFAULT_SESSION_FILE = '.flask_sessions'
+DEFAULT_SESSION_SLOTS = 16384
+DEFAULT_SESSION_SLOT_SIZE = 2048
+SESSION_ID_LENGTH = 32
+MMAP_MAGIC = b'FASESS01'
+MMAP_HEADER = struct.Struct('!8sII')
+MMAP_SLOT_HEADER = struct.Struct(f'!{SESSION_ID_LENGTH}sdI') # session id, expires, data length
+MMAP_MAX_PROBE = 8
+
+_SESSION_ID_RE = re.compile(f'^[A-Za-z0-9_-]{{{SESSION_ID_LENGTH}}}$')
+
+
+def new_session_id() -> str:
+    ''' Return a new random session id (192 bits) '''
+    return secrets.token_urlsafe(SESSION_ID_LENGTH * 3 // 4)
+
+
+class MemorySessionStore:
+    ''' Per process LRU session store.  Sessions are lost on restart and are not shared between worker processes '''
+    def __init__(self, max_entries:int=DEFAULT_SESSION_ENTRIES):
+        self._cache = LRUCache(max_entries=max_entries)
+
+    @property
+    def stats(self) -> dict:
+        return self._cache.stats
+
+    def get(self, sid:str) -> tuple[dict, float]|None:
+        ''' Return (session data, expires) or None if the session does not exist '''
+        return self._cache.get(sid, None)
+
+    def set(self, sid:str, data:dict, ttl:float) -> bool:
+        ''' Store a session for ttl seconds '''
+        self._cache.set(sid, (dict(data), time() + ttl), ttl=ttl)
+        return True
+
+    def delete(self, sid:str):
+        self._cache.pop(sid)
+
+    def close(self):
+        self._cache.clear()
+
+
+class MmapSessionStore:
+    ''' Session store in a memory mapped file of fixed size slots (open addressing on the session id).
+        The file is shared by all processes on the host that open it (flock is used between processes) and survives restarts.
+        When the probed slots are all in use the session closest to expiring is evicted.  Sessions that do not fit in a slot are
+        not stored '''
+    def __init__(self, path:str=DEFAULT_SESSION_FILE, slots:int=DEFAULT_SESSION_SLOTS, slot_size:int=DEFAULT_SESSION_SLOT_SIZE, logger=logging):
+        if slot_size <= MMAP_SLOT_HEADER.size:
+            raise ValueError(f"slot_size must be larger than {MMAP_SLOT_HEADER.size}")
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self._logger = logger
+        self._serializer = TaggedJSONSerializer()
+        self._lock = Lock()
+        self._file = None
+        self._map = None
+        self._pid = None
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'oversize': 0}
+
+    @property
+    def stats(self) -> dict:
+        return dict(self.counters)
+
+    @property
+    def capacity(self) -> int:
+        ''' Largest serialized session (bytes) that fits in a slot '''
+        return self.slot_size - MMAP_SLOT_HEADER.size
+
+    def get(self, sid:str) -> tuple[dict, float]|None:
+        ''' Return (session data, expires) or None if the session does not exist '''
+        key = sid.encode('ascii')
+        with self._locked(exclusive=False) as data_map:
+            for offset in self._probe(key):
+                slot_sid, expires, length = MMAP_SLOT_HEADER.unpack_from(data_map, offset)
+                if slot_sid == key:
+                    if expires <= time():
+                        break
+                    payload = data_map[offset + MMAP_SLOT_HEADER.size:offset + MMAP_SLOT_HEADER.size + length]
+                    self.counters['hits'] += 1
+                    return self._serializer.loads(payload.decode('utf-8')), expires
+        self.counters['misses'] += 1
+        return None
+
+    def set(self, sid:str, data:dict, ttl:float) -> bool:
+        ''' Store a session for ttl seconds.  Returns False if the session is too large for a slot '''
+        payload = self._serializer.dumps(dict(data)).encode('utf-8')
+        if len(payload) > self.capacity:
+            self.counters['oversize'] += 1
+            self._logger.warning(f"{self.__class__.__name__}: session is {len(payload)} bytes, slot capacity is {self.capacity} bytes. Not stored")
+            return False
+        key = sid.encode('ascii')
+        now = time()
+        with self._locked(exclusive=True) as data_map:
+            target = None
+            oldest = None
+            for offset in self._probe(key):
+                slot_sid, expires, _ = MMAP_SLOT_HEADER.unpack_from(data_map, offset)
+                if slot_sid == key:
+                    target = offset
+                    break
+                if target is None and (slot_sid == bytes(SESSION_ID_LENGTH) or expires <= now):
+                    target = offset
+                if oldest is None or expires < oldest[1]:
+                    oldest = (offset, expires)
+            if target is None:
+                target = oldest[0]
+                self.counters['evictions'] += 1
+            MMAP_SLOT_HEADER.pack_into(data_map, target, key, now + ttl, len(payload))
+            data_map[target + MMAP_SLOT_HEADER.size:target + MMAP_SLOT_HEADER.size + len(payload)] = payload
+        return True
+
+    def delete(self, sid:str):
+        key = sid.encode('ascii')
+        with self._locked(exclusive=True) as data_map:
+            for offset in self._probe(key):
+                if MMAP_SLOT_HEADER.unpack_from(data_map, offset)[0] == key:
+                    MMAP_SLOT_HEADER.pack_into(data_map, offset, bytes(SESSION_ID_LENGTH), 0, 0)
+                    break
+
+    def close(self):
+        ''' Unmap and close the file '''
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._file.close()
+            self._map = None
+            self._file = None
+
+    def _probe(self, key:bytes):
+        ''' Yield the slot offsets to try for a session id '''
+        start = crc32(key) % self.slots
+        for i in range(min(MMAP_MAX_PROBE, self.slots)):
+            yield MMAP_HEADER.size + ((start + i) % self.slots) * self.slot_size
+
+    def _open(self):
+        ''' Open (or create) the file and map it.  A file with a different layout is recreated '''
+        size = MMAP_HEADER.size + self.slots * self.slot_size
+        file = open(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b')
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            file.seek(0)
+            header = file.read(MMAP_HEADER.size)
+            if len(header) != MMAP_HEADER.size or MMAP_HEADER.unpack(header) != (MMAP_MAGIC, self.slots, self.slot_size) or \
+                    os.fstat(file.fileno()).st_size != size:
+                if header:
+                    self._logger.warning(f"{self.__class__.__name__}: {self.path} has a different layout, recreating")
+                file.truncate(0)
+                file.truncate(size)
+                file.seek(0)
+                file.write(MMAP_HEADER.pack(MMAP_MAGIC, self.slots, self.slot_size))
+                file.flush()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_UN)
+        self._file = file
+        self._map = mmap.mmap(file.fileno(), size)
+        self._pid = os.getpid()
+
+    def _locked(self, exclusive:bool):
+        return _MmapLock(self, exclusive)
+
+
+class _MmapLock:
+    ''' Context manager holding the thread lock and the file lock, returns the map.  Re-opens the file in a forked process so
+        each process has its own flock '''
+    __slots__ = ('store', 'exclusive')
+
+    def __init__(self, store:MmapSessionStore, exclusive:bool):
+        self.store = store
+        self.exclusive = exclusive
+
+    def __enter__(self):
+        store = self.store
+        store._lock.acquire()
+        try:
+            if store._map is None or store._pid != os.getpid():
+                store._open()
+            if fcntl is not None:
+                fcntl.flock(store._file, fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        except BaseException:
+            store._lock.release()
+            raise
+        return store._map
+
+    def __exit__(self, *args):
+        store = self.store
+        try:
+            if fcntl is not None:
+                fcntl.flock(store._file, fcntl.LOCK_UN)
+        finally:
+            store._lock.release()
+
+
+class ServerSession(SecureCookieSession):
+    ''' Session with the data held in a session store.  sid is the id carried by the cookie '''
+    def __init__(self, initial=None, sid:str|None=None, expires:float|None=None, new:bool=False):
+        super().__init__(initial)
+        self.sid = sid if sid is not None else new_session_id()
+        self.expires = expires
+        self.new = new
+        self.previous_sid = None
+
+    def regenerate(self):
+        ''' Move the session to a new id (i.e. after login, to prevent session fixation) '''
+        if self.previous_sid is None and not self.new:
+            self.previous_sid = self.sid
+        self.sid = new_session_id()
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    ''' Flask session interface for a session store.  A session is written back when it changes (or when less than half of
+        the ttl is left) and the cookie is only sent when the session id changes or Flask's refresh rules require it '''
+    def __init__(self, store, ttl:float=DEFAULT_SESSION_TTL):
+        self.store = store
+        self.ttl = ttl
+
+    def open_session(self, app, request) -> ServerSession:
+        sid = request.cookies.get(self.get_cookie_name(app), None)
+        if sid is not None and _SESSION_ID_RE.match(sid):
+            entry = self.store.get(sid)
+            if entry is not None:
+                return ServerSession(entry[0], sid=sid, expires=entry[1])
+        return ServerSession(new=True)
+
+    def save_session(self, app, session:ServerSession, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        partitioned = self.get_cookie_partitioned(app) if hasattr(self, 'get_cookie_partitioned') else False
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+            session.previous_sid = None
+
+        if not session:
+            # emptied (i.e. logout) - remove the stored session and the cookie
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly,
+                                       **({'partitioned': partitioned} if partitioned else {}))
+            return
+
+        ttl = app.permanent_session_lifetime.total_seconds() if session.permanent else self.ttl
+        if session.modified or session.new or session.expires is None or session.expires - time() < ttl / 2:
+            self.store.set(session.sid, session, ttl)
+        if session.modified or session.new or self.should_set_cookie(app, session):
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session), httponly=httponly, domain=domain,
+                                path=path, secure=secure, samesite=samesite, **({'partitioned': partitioned} if partitioned else {}))
+
+
+def create_session_store(config:dict, logger=logging):
+    ''' Build the session store for a 'session' config block '''
+    store = config.get('store', MEMORY_STORE)
+    if store == MEMORY_STORE:
+        return MemorySessionStore(max_entries=config.get('max_entries', DEFAULT_SESSION_ENTRIES))
+    if store == MMAP_STORE:
+        return MmapSessionStore(path=config.get('file', DEFAULT_SESSION_FILE), slots=config.get('slots', DEFAULT_SESSION_SLOTS),
+                                slot_size=config.get('slot_size', DEFAULT_SESSION_SLOT_SIZE), logger=logger)
+    raise ValueError(f"session store must be '{MEMORY_STORE}' or '{MMAP_STORE}'. Got: {store}")
@@ -0,0 +1,283 @@
+'''
+In-memory cache for static files served by FlaskApp.  Keeps hot files in memory under a byte budget and
+precomputes the validators (ETag / Last-Modified) used to answer conditional GET requests.
+Files above the cache file size threshold are streamed from disk, both are served with HTTP Range support.
+'''
+
+import os
+import gzip
+import hashlib
+import mimetypes
+import uuid
+from datetime import datetime, timezone
+from fnmatch import fnmatch
+from threading import Lock
+from time import monotonic
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
+from .cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_STATIC_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_STATIC_CACHE_FILE_SIZE = 4 * 1024 * 1024
+DEFAULT_STATIC_CHECK_INTERVAL = 2
+DEFAULT_PRECOMPRESS_MIN_SIZE = 1024
+LARGE_FILE_BUFFER_SIZE = 1024 * 1024
+
+COMPRESSIBLE_EXTENSIONS = ('.js', '.css', '.html', '.htm', '.j2', '.json', '.map', '.svg', '.txt', '.xml', '.ttf', '.otf', '.eot')
+
+# precompressed sibling suffix for each content encoding, in order of preference
+PRECOMPRESSED_VARIANTS = (('br', '.br'), ('gzip', '.gz'))
+
+
+class StaticEntry:
+    ''' Represents a static file.  data is None if the file is too large to be held in memory '''
+    __slots__ = ('path', 'size', 'mtime', 'mtime_ns', 'etag', 'mimetype', 'data', 'checked')
+
+    def __init__(self, path:str, size:int, mtime:float, mtime_ns:int, etag:str, mimetype:str, data:bytes|None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.mtime_ns = mtime_ns
+        self.etag = etag
+        self.mimetype = mimetype
+        self.data = data
+        self.checked = monotonic()
+
+
+class StaticCache:
+    ''' LRU cache of static file contents and validators.
+        Files are re-checked on disk at most once every check_interval seconds.
+        cache_control is a dict of route glob patterns to a Cache-Control header value, first match wins:
+            {"/js/*": "public, max-age=3600", "*": "no-cache"}
+    '''
+    def __init__(self, max_bytes:int=DEFAULT_STATIC_CACHE_BYTES, max_file_size:int=DEFAULT_STATIC_CACHE_FILE_SIZE,
+                 check_interval:float=DEFAULT_STATIC_CHECK_INTERVAL, cache_control:dict|None=None):
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.check_interval = check_interval
+        self.cache_control_map = cache_control if cache_control is not None else {}
+        self._content = LRUCache(max_bytes=max_bytes)
+        self._meta = {} # path -> StaticEntry for files that are not held in memory
+        self._cache_control = {}
+        self._variants = {} # path -> (checked, tuple of available encodings)
+        self._lock = Lock()
+
+    @property
+    def stats(self) -> dict:
+        ''' Returns the content cache counters '''
+        return self._content.stats
+
+    def lookup(self, path:str) -> StaticEntry:
+        ''' Return the entry for a file path, loading it from disk if it is new or has changed.  Raises OSError if the file is missing '''
+        entry = self._content.get(path, None) or self._meta.get(path, None)
+        if entry is not None:
+            if monotonic() - entry.checked < self.check_interval:
+                return entry
+            stat = os.stat(path)
+            if stat.st_size == entry.size and stat.st_mtime_ns == entry.mtime_ns:
+                entry.checked = monotonic()
+                return entry
+        else:
+            stat = os.stat(path)
+        return self._load(path, stat)
+
+    def lookup_encoded(self, path:str, accept_encoding) -> tuple[StaticEntry, str|None]:
+        ''' Return the best precompressed variant of a file accepted by the client along with the content encoding.
+            Returns the original file and None if no acceptable variant exists.  accept_encoding is a werkzeug Accept object.
+        Variants older than the original are stale (the file was edited after compressing) and are not used '''
+        entry = self.lookup(path)
+        for encoding, suffix in self.variants(path):
+            if accept_encoding.quality(encoding) > 0:
+                try:
+                    variant = self.lookup(path + suffix)
+                except OSError:
+                    # variant was removed from disk
+                    self._variants.pop(path, None)
+                    continue
+                if variant.mtime_ns >= entry.mtime_ns:
+                    return variant, encoding
+        return entry, None
+
+    def variants(self, path:str) -> tuple:
+        ''' Return the (encoding, suffix) pairs of the precompressed siblings that exist for a file '''
+        checked, variants = self._variants.get(path, (None, ()))
+        if checked is None or monotonic() - checked >= self.check_interval:
+            variants = tuple((encoding, suffix) for encoding, suffix in PRECOMPRESSED_VARIANTS if os.path.isfile(path + suffix)) \
+                if path.endswith(COMPRESSIBLE_EXTENSIONS) else ()
+            self._variants[path] = (monotonic(), variants)
+        return variants
+
+    def invalidate(self, path:str|None=None):
+        ''' Drop a single file, or everything if no path is given '''
+        with self._lock:
+            if path is None:
+                self._content.invalidate()
+                self._meta.clear()
+                self._variants.clear()
+            else:
+                self._content.pop(path)
+                self._meta.pop(path, None)
+                self._variants.pop(path, None)
+
+    def cache_control(self, route:str) -> str|None:
+        ''' Return the Cache-Control header configured for a route (or None) '''
+        if route not in self._cache_control:
+            self._cache_control[route] = next((value for pattern, value in self.cache_control_map.items() if fnmatch(route, pattern)), None)
+        return self._cache_control[route]
+
+    def _load(self, path:str, stat:os.stat_result) -> StaticEntry:
+        ''' Read the file (if small enough) and calculate the validators '''
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if stat.st_size <= self.max_file_size:
+            with open(path, 'rb') as input_file:
+                data = input_file.read()
+            entry = StaticEntry(path, len(data), stat.st_mtime, stat.st_mtime_ns, hashlib.sha1(data).hexdigest(), mimetype, data)
+            with self._lock:
+                self._meta.pop(path, None)
+                self._content.set(path, entry, size=entry.size)
+        else:
+            entry = StaticEntry(path, stat.st_size, stat.st_mtime, stat.st_mtime_ns, f"{stat.st_mtime_ns:x}-{stat.st_size:x}", mimetype, None)
+            with self._lock:
+                self._content.pop(path)
+                self._meta[path] = entry
+        return entry
+
+
+def send_static_entry(request, response_class, entry:StaticEntry, headers:dict|None=None, buffer_size:int=LARGE_FILE_BUFFER_SIZE):
+    ''' Build a response for a static cache entry, answered from entry.data if the file is held in memory and from disk otherwise.
+        Full responses for files on disk hand the open file to the server's wsgi.file_wrapper (sendfile capable servers will use zero copy).
+        Single and multiple byte ranges are answered with 206 (multipart/byteranges for more than one range) '''
+    last_modified = datetime.fromtimestamp(int(entry.mtime), timezone.utc)
+    response = response_class(mimetype=entry.mimetype, headers=headers, direct_passthrough=True)
+    response.set_etag(entry.etag)
+    response.last_modified = last_modified
+    response.accept_ranges = 'bytes'
+    if not is_resource_modified(request.environ, etag=entry.etag, last_modified=last_modified):
+        response.status_code = 304
+        return response
+
+    ranges = None
+    if request.range is not None and request.range.units == 'bytes' and \
+            ('HTTP_IF_RANGE' not in request.environ or not is_resource_modified(request.environ, etag=entry.etag, last_modified=last_modified, ignore_if_range=False)):
+        ranges = _satisfiable_ranges(request.range.ranges, entry.size)
+        if not ranges:
+            response.status_code = 416
+            response.headers['Content-Range'] = f"bytes */{entry.size}"
+            return response
+
+    if ranges is None:
+        response.response = [entry.data] if entry.data is not None else wrap_file(request.environ, open(entry.path, 'rb'), buffer_size)
+        response.content_length = entry.size
+        return response
+
+    response.status_code = 206
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        parts, trailer = [(None, start, stop)], None
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{entry.size}"
+    else:
+        boundary = uuid.uuid4().hex
+        parts, trailer = _multipart_parts(ranges, entry.size, response.content_type, boundary)
+        response.content_type = f"multipart/byteranges; boundary={boundary}"
+    response.content_length = sum(len(part_header or b'') + stop - start for part_header, start, stop in parts) + len(trailer or b'')
+    if entry.data is not None:
+        response.response = _iter_data_ranges(entry.data, parts, trailer)
+    else:
+        response.response = _iter_file_ranges(open(entry.path, 'rb'), parts, buffer_size, trailer)
+    return response
+
+
+def _multipart_parts(ranges:list, length:int, content_type:str, boundary:str) -> tuple[list, bytes]:
+    ''' Return the (part header, start, stop) parts and the closing boundary of a multipart/byteranges body '''
+    parts = [(f"\r\n--{boundary}\r\nContent-Type: {content_type}\r\nContent-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n".encode(), start, stop)
+             for start, stop in ranges]
+    return parts, f"\r\n--{boundary}--\r\n".encode()
+
+
+def _satisfiable_ranges(ranges:list, length:int) -> list:
+    ''' Convert parsed Range header values to absolute (start, stop) offsets, dropping unsatisfiable ranges and merging overlaps '''
+    result = []
+    for start, stop in ranges:
+        if start < 0:
+            start, stop = max(length + start, 0), length
+        elif stop is None or stop > length:
+            stop = length
+        if start < stop:
+            result.append((start, stop))
+    result.sort()
+    merged = []
+    for start, stop in result:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def _iter_data_ranges(data:bytes, parts:list, trailer:bytes|None=None):
+    ''' Generator that yields (part header, start, stop) slices of in memory file data '''
+    for part_header, start, stop in parts:
+        if part_header is not None:
+            yield part_header
+        yield data[start:stop]
+    if trailer is not None:
+        yield trailer
+
+
+def _iter_file_ranges(file, parts:list, buffer_size:int, trailer:bytes|None=None):
+    ''' Generator that yields (part header, start, stop) slices of an open file and closes it when done '''
+    try:
+        for part_header, start, stop in parts:
+            if part_header is not None:
+                yield part_header
+            file.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                data = file.read(min(buffer_size, remaining))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+        if trailer is not None:
+            yield trailer
+    finally:
+        file.close()
+
+
+def precompress_files(files:list, min_size:int=DEFAULT_PRECOMPRESS_MIN_SIZE) -> int:
+    ''' Build .gz (and .br if the brotli package is installed) siblings for the compressible files in the list.
+        Siblings that are already up to date (or shipped precompressed) are left untouched, stale siblings that are no longer worth
+        serving are removed.  Returns the number of files written '''
+    written = 0
+    encoders = [('.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        encoders.append(('.br', lambda data: brotli.compress(data, quality=11)))
+    for path in files:
+        if not path.endswith(COMPRESSIBLE_EXTENSIONS) or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        if stat.st_size < min_size:
+            continue
+        data = None
+        for suffix, encoder in encoders:
+            exists = os.path.isfile(path + suffix)
+            if exists and os.stat(path + suffix).st_mtime_ns >= stat.st_mtime_ns:
+                continue
+            if data is None:
+                with open(path, 'rb') as input_file:
+                    data = input_file.read()
+            compressed = encoder(data)
+            if len(compressed) >= len(data):
+                # not worth serving
+                if exists:
+                    os.remove(path + suffix)
+                continue
+            with open(path + suffix + '.tmp', 'wb') as output_file:
+                output_file.write(compressed)
+            os.replace(path + suffix + '.tmp', path + suffix)
+            written += 1
+    return written
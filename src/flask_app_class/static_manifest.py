@@ -0,0 +1,203 @@
+'''
+Static file manifest.  Scans the static roots concurrently and persists (size, mtime, hash) for every file so a restart
+only needs to re-hash files that changed.  StaticWatcher keeps the manifest current while the app is running using
+inotify (if the optional inotify_simple package is installed) or polling.
+'''
+
+import os
+import json
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread, Event
+from typing import Callable
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+DEFAULT_MANIFEST_FILE = '.static_manifest.json'
+DEFAULT_SCAN_WORKERS = 8
+DEFAULT_POLL_INTERVAL = 2
+MANIFEST_VERSION = 1
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class StaticManifest:
+    ''' Holds (size, mtime_ns, sha1) for every static file found under a set of roots.  Optionally persisted to manifest_file '''
+    def __init__(self, manifest_file:str|None=DEFAULT_MANIFEST_FILE, workers:int=DEFAULT_SCAN_WORKERS, logger=logging):
+        self.manifest_file = manifest_file
+        self.workers = workers
+        self._logger = logger
+        self._lock = Lock()
+        self.files = {} # file path -> (size, mtime_ns, hash)
+        self.directories = set()
+        self.roots = {} # root path -> sorted list of files
+        self._load()
+
+    def file_hash(self, path:str) -> str|None:
+        ''' Return the content hash of a file in the manifest (None if not found) '''
+        entry = self.files.get(path, None)
+        return entry[2] if entry is not None else None
+
+    def scan(self, roots:list) -> dict:
+        ''' Scan all roots concurrently.  Returns a dict of root -> sorted list of files.  Only new or changed files are hashed '''
+        found = {}
+        directories = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {executor.submit(_scan_dir, root): root for root in roots if os.path.isdir(root)}
+            for root in roots:
+                found[root] = []
+            while pending:
+                future = next(iter(pending))
+                root = pending.pop(future)
+                files, subdirs = future.result()
+                found[root].extend(files)
+                for subdir in subdirs:
+                    directories.add(subdir)
+                    pending[executor.submit(_scan_dir, subdir)] = root
+            directories.update(root for root in roots if os.path.isdir(root))
+
+            # hash new or modified files
+            all_files = {path: stat for root in found for path, stat in found[root]}
+            changed = [path for path, stat in all_files.items() if self.files.get(path, (None, None))[:2] != stat]
+            hashes = dict(zip(changed, executor.map(hash_file, changed)))
+
+        with self._lock:
+            updated = bool(changed) or set(all_files) != set(self.files)
+            self.files = {path: stat + (hashes[path] if path in hashes else self.files[path][2],) for path, stat in all_files.items() if hashes.get(path, '') is not None}
+            self.directories = directories
+            self.roots = {root: sorted(path for path, _ in found[root] if path in self.files) for root in found}
+        if changed:
+            self._logger.debug(f"StaticManifest: hashed {len(changed)} new or modified files")
+        if updated:
+            self.save()
+        return self.roots
+
+    def save(self):
+        ''' Write the manifest file (if configured) '''
+        if self.manifest_file is None:
+            return
+        try:
+            with open(self.manifest_file + '.tmp', 'w', encoding='utf-8') as output_file:
+                output_file.write(json.dumps({'version': MANIFEST_VERSION, 'files': self.files}))
+            os.replace(self.manifest_file + '.tmp', self.manifest_file)
+        except OSError as e:
+            self._logger.warning(f"StaticManifest: unable to write {self.manifest_file}: {e}")
+
+    def _load(self):
+        ''' Read the manifest file if it exists.  An unreadable manifest is ignored and rebuilt on the next scan '''
+        if self.manifest_file is None or not os.path.isfile(self.manifest_file):
+            return
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as input_file:
+                data = json.loads(input_file.read())
+            if data.get('version') == MANIFEST_VERSION:
+                self.files = {path: tuple(entry) for path, entry in data.get('files', {}).items()}
+        except (OSError, ValueError) as e:
+            self._logger.warning(f"StaticManifest: ignoring unreadable manifest {self.manifest_file}: {e}")
+
+
+class StaticWatcher:
+    ''' Background thread that rescans the manifest when the static directories change and calls on_change(roots) with the new file lists '''
+    def __init__(self, manifest:StaticManifest, roots:list, on_change:Callable, poll_interval:float=DEFAULT_POLL_INTERVAL, logger=logging):
+        self.manifest = manifest
+        self.roots = roots
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self._logger = logger
+        self._stop = Event()
+        self._thread = None
+        self._inotify = None
+        self._watched = set()
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        ''' Start watching for changes '''
+        if self.is_running:
+            return
+        self._stop.clear()
+        if INotify is not None:
+            try:
+                self._inotify = INotify()
+                self._add_watches()
+            except OSError as e:
+                self._logger.warning(f"StaticWatcher: inotify unavailable, falling back to polling: {e}")
+                self._inotify = None
+        self._thread = Thread(target=self._run, name='StaticWatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        ''' Stop the watcher thread '''
+        self._stop.set()
+        if self.is_running:
+            self._thread.join(timeout=self.poll_interval + 1)
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._watched = set()
+
+    def _add_watches(self):
+        ''' Add an inotify watch for every directory in the manifest that is not already watched '''
+        mask = inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.MOVED_TO | inotify_flags.MOVED_FROM | inotify_flags.CLOSE_WRITE
+        for directory in self.manifest.directories - self._watched:
+            try:
+                self._inotify.add_watch(directory, mask)
+                self._watched.add(directory)
+            except OSError:
+                pass
+
+    def _run(self):
+        ''' Wait for a change (inotify event or poll interval) and rescan '''
+        while not self._stop.is_set():
+            if self._inotify is not None:
+                if not self._inotify.read(timeout=int(self.poll_interval * 1000)):
+                    continue
+                # let a burst of events (i.e. a deploy) settle before rescanning
+                self._stop.wait(0.2)
+                self._inotify.read(timeout=0)
+            elif self._stop.wait(self.poll_interval):
+                break
+            previous = self.manifest.files
+            try:
+                roots = self.manifest.scan(self.roots)
+            except Exception as e:
+                self._logger.error(f"StaticWatcher: rescan failed: {e.__class__.__name__}: {e}")
+                continue
+            if self._inotify is not None:
+                self._add_watches()
+            if self.manifest.files != previous:
+                changed = {path for path in set(previous) | set(self.manifest.files) if previous.get(path) != self.manifest.files.get(path)}
+                self.on_change(roots, changed)
+
+
+def _scan_dir(path:str) -> tuple[list, list]:
+    ''' Return ([(file path, (size, mtime_ns))], [sub directories]) for a single directory '''
+    files, subdirs = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((entry.path, (stat.st_size, stat.st_mtime_ns)))
+                elif entry.is_dir():
+                    subdirs.append(entry.path)
+    except OSError:
+        pass
+    return files, subdirs
+
+
+def hash_file(path:str) -> str|None:
+    ''' Return the sha1 of a file, None if it can not be read '''
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as input_file:
+            for block in iter(lambda: input_file.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
@@ -1,11 +1,29 @@
-from flask_login import UserMixin
 import logging
+from flask import request, has_request_context
+from werkzeug.exceptions import TooManyRequests
+from math import ceil
+from .cache import LRUCache
+from .login_throttle import LoginThrottle
+
+DEFAULT_USER_CACHE_ENTRIES = 4096
+DEFAULT_USER_CACHE_TTL = 60
+
 
 class FlaskUserController:
-    ''' Parent class to handle basic user management functions.  Tasks should be overriden by an inherritting class  '''
-    def __init__(self, logger=logging):
+    ''' Parent class to handle basic user management functions.  Tasks should be overriden by an inherritting class.
+        user_cache enables a per process cache of the FlaskUser objects returned by load_user (the Flask-Login user_loader):
+            {"ttl": 60, "max_entries": 4096}
+        Subclasses must call invalidate_user when a user changes.
+        login_throttle enables throttling of login attempts per username and client address (see LoginThrottle).  Subclasses call
+        throttle_login before contacting the authentication backend and login_result with the outcome '''
+    def __init__(self, logger=logging, user_cache:dict|None=None, login_throttle:dict|None=None):
         self._logger = logger
         self._inherit_info_str = ''
+        self.login_throttle = LoginThrottle.from_config(login_throttle) if login_throttle is not None else None
+        self._user_cache = None
+        if user_cache is not None:
+            self._user_cache = LRUCache(max_entries=user_cache.get('max_entries', DEFAULT_USER_CACHE_ENTRIES),
+                                        ttl=user_cache.get('ttl', DEFAULT_USER_CACHE_TTL))
 
     def __del__(self):
         self.close()
@@ -22,13 +40,61 @@ class FlaskUserController:
         ''' Authenticate a user and return a FlaskUser object '''
         return NotImplemented
 
+    def throttle_login(self, username:str):
+        ''' Raise TooManyRequests (429 with Retry-After) if the login attempt is over the username or client address limits.
+            The client address is the request remote_addr (corrected by ProxyFix when behind_proxy is set) '''
+        if self.login_throttle is None:
+            return
+        remote_addr = request.remote_addr if has_request_context() else None
+        retry_after = self.login_throttle.check(username, remote_addr)
+        if retry_after > 0:
+            self._logger.warning(f"{self.info_str}: {username}: Login throttled from {remote_addr}, retry after {retry_after:.1f}s")
+            raise TooManyRequests(retry_after=ceil(retry_after))
+
+    def login_result(self, username:str, success:bool):
+        ''' Record the outcome of a login attempt for the progressive lockout '''
+        if self.login_throttle is not None:
+            self.login_throttle.result(username, request.remote_addr if has_request_context() else None, success)
+
     def authorize_user(self, username:str, **kwargs):
-        ''' Authorize a user based on criteria that is passed '''
+        ''' Authorize a user based on criteria that is passed (i.e. roles=[...]).  Returns True if the user is authorized '''
         return NotImplemented
 
+    def session_started(self, user_id):
+        ''' Called when a user logs in to the web session (i.e. to start accounting) '''
+        pass
+
+    def session_ended(self, user_id):
+        ''' Called when a user logs out of the web session '''
+        pass
+
     def get_user(self, username=None, user_id=None):
         ''' Find a user from a username or user_id '''
         return NotImplemented
+
+    def load_user(self, user_id):
+        ''' Flask-Login user_loader.  Returns the user from the user cache, or from get_user '''
+        if self._user_cache is None:
+            return self.get_user(user_id=user_id)
+        user = self._user_cache.get(user_id, None)
+        if user is None:
+            user = self.get_user(user_id=user_id)
+            if isinstance(user, FlaskUser):
+                self._user_cache.set(user_id, user)
+        return user
+
+    def invalidate_user(self, user_id=None) -> int:
+        ''' Remove a user (or all users) from the user cache.  Returns the number of entries removed '''
+        if self._user_cache is None:
+            return 0
+        if user_id is None:
+            return self._user_cache.invalidate()
+        return 1 if self._user_cache.pop(user_id) is not None else 0
+
+    @property
+    def user_cache_stats(self) -> dict|None:
+        ''' Returns the user cache counters (None if the cache is disabled) '''
+        return self._user_cache.stats if self._user_cache is not None else None
     
     def enable_user(self, user_id):
         ''' Mark a user as enabled '''
@@ -51,36 +117,81 @@ class FlaskUserController:
         return NotImplemented
         
 
-class FlaskUser(UserMixin):
+class FlaskUser:
     '''
-    Represents a user that has attempted a login via the FlaskLoginController. 
-    Extends the Flask UserMixin class to represent the user. Base class includes __eq__ and __ne__ functions
+    Represents a user that has attempted a login via the FlaskLoginController.
+    Immutable value object implementing the Flask-Login user interface (is_authenticated, is_active, is_anonymous, get_id).
+    Users with the same id compare equal
     '''
-    def __init__(self, user_id:str|int, username:str, auth_ok:bool, acct_active:bool):
-        ''' Create an instance to represent a user login ''' 
-        self._user_data = (user_id, username, auth_ok, acct_active)
+    __slots__ = ('_user_id', '_username', '_auth_ok', '_acct_active', '_roles')
+
+    def __init__(self, user_id:str|int, username:str, auth_ok:bool, acct_active:bool, roles=None):
+        ''' Create an instance to represent a user login '''
+        object.__setattr__(self, '_user_id', user_id)
+        object.__setattr__(self, '_username', username)
+        object.__setattr__(self, '_auth_ok', auth_ok)
+        object.__setattr__(self, '_acct_active', acct_active)
+        object.__setattr__(self, '_roles', frozenset(roles) if roles is not None else frozenset())
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
 
     @property
     def is_active(self):
         ''' is_active returns True if the account is active (not suspended or rejected for reasons other than auth) '''
-        return self._user_data[4]
+        return self._acct_active
 
     @property
     def username(self):
-        return self._user_data[1]
+        return self._username
 
     @property
     def name(self):
-        return self.user_data[1]
+        return self._username
 
     @property
     def is_authenticated(self):
         ''' Returns True if the account is authenticated '''
-        return self._user_data[2]
+        return self._auth_ok
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    @property
+    def roles(self) -> frozenset:
+        ''' Returns the roles / groups of the user (from the authentication backend) '''
+        return self._roles
+
+    def has_role(self, *roles) -> bool:
+        ''' Returns True if the user has any of the roles '''
+        return not self._roles.isdisjoint(roles)
 
     def get_id(self):
-        return self._user_data[0]
+        return self._user_id
+
+    def replace(self, **kwargs):
+        ''' Return a copy of the user with the given fields (user_id, username, auth_ok, acct_active, roles) changed '''
+        fields = {'user_id': self._user_id, 'username': self._username, 'auth_ok': self._auth_ok, 'acct_active': self._acct_active,
+                  'roles': self._roles}
+        fields.update(kwargs)
+        return FlaskUser(**fields)
+
+    def __eq__(self, other):
+        if isinstance(other, FlaskUser):
+            return self._user_id == other._user_id
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self._user_id)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self._user_id!r}, {self._username!r}, {self._auth_ok!r}, {self._acct_active!r}, roles={set(self._roles)!r})"
 
     def __str__(self):
         ''' Return the username and ID as a string '''
-        return f"{self.username}({self.get_id()})"
\ No newline at end of file
+        return f"{self.username}({self.get_id()})"
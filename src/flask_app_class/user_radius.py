@@ -1,6 +1,24 @@
+import os
+import json
+import hashlib
 import logging
+from threading import Lock
+from time import monotonic, time
+from flask import session, has_request_context
+from .cache import LRUCache, SingleFlight
 from .user_controller import FlaskUserController, FlaskUser
-from ._radius import Radius, DEFAULT_RETRIES, DEFAULT_TIMEOUT
+from ._radius import Radius, RadiusPool, RadiusAccounting, cooperative, offload, vendor_attributes, DEFAULT_RETRIES, DEFAULT_TIMEOUT, DEFAULT_MIN_TIMEOUT, ROUND_ROBIN, DEFAULT_MAX_FAILURES, DEFAULT_EJECT_TIME, DEFAULT_PROBE_INTERVAL
+
+DEFAULT_AUTH_CACHE_ENTRIES = 4096
+DEFAULT_AUTH_CACHE_TTL = 300
+DEFAULT_AUTH_CACHE_NEGATIVE_TTL = 10
+DEFAULT_AUTH_CACHE_ITERATIONS = 20000
+DEFAULT_ROLE_ATTRIBUTES = ['Class', 'Filter-Id', 'Tunnel-Private-Group-ID', 'Vendor-Specific']
+DEFAULT_ROLE_TTL = 3600
+DEFAULT_ACCT_PORT = 1813
+DEFAULT_USER_TABLE_CHECK_INTERVAL = 5
+SESSION_ROLES_KEY = '_radius_roles'
+SESSION_ACCT_KEY = '_radius_acct_session'
 
 
 class RadiusUserController(FlaskUserController):
@@ -9,32 +27,313 @@ class RadiusUserController(FlaskUserController):
             - Radius user controller only supports read methods, 
             - user_id is the username
             - user_table is a list of user id's that should be permitted (can be used to filter users): [1, 55, 132]
+              user_table_file loads the list from a file (JSON list, or one user id per line) and reloads it when the file changes
+            - users can be disabled locally with disable_user (rejected at login and dropped from existing sessions)
+            - user_cache caches the users returned to Flask-Login (see FlaskUserController), set to false to disable
+            - login_throttle limits login attempts per username and client address before they reach the RADIUS server, see
+              LoginThrottle.  Attempts over the limit raise werkzeug TooManyRequests (429)
+            - multiple servers can be configured with 'servers' (each entry takes host, port and optionally shared_secret, which defaults
+              to the top level shared_secret).  Requests fail over between servers, see RadiusPool for the balance / health options
+            - with adaptive_timeout the retransmit timeout follows the measured server response time (timeout is the upper bound),
+              deadline limits the total time for a request
+            - auth_cache enables a cache of recent authentication results so repeat logins skip the RADIUS server:
+                {"ttl": 300, "negative_ttl": 10, "max_entries": 4096, "iterations": 20000}
+              entries are keyed on the username and a salted PBKDF2 digest of the password, the password itself is never stored
+            - concurrent logins for the same username and password are coalesced into a single RADIUS request and share its result
+            - roles are taken from the Access-Accept reply attributes and kept for ttl seconds after login, so authorize_user and
+              get_user do not need another RADIUS request.  The roles and their expiry are stored in the web session (shared by all
+              workers with a server side session store), the per process cache only saves decoding them.  A user stays logged in
+              for as long as the Flask-Login session lasts, after the role ttl the user only has the 'default' roles:
+                {"attributes": ["Class", "Filter-Id", "Tunnel-Private-Group-ID", "Vendor-Specific"],
+                 "map": {"Class:admins": "admin", "web-users": ["user"]}, "default": [], "ttl": 3600, "max_entries": 4096}
+              map keys are an attribute value, or 'Attribute-Name:value' to match a single attribute.  Without a map the attribute
+              values are used as the roles
+            - accounting sends Accounting Start / Interim-Update / Stop records for web sessions (see RadiusAccounting) from a background
+              queue so logins and logouts do not wait on the server:
+                {"port": 1813, "spill_file": ".radius_accounting", "queue_size": 4096, "interim_interval": 600, "nas_identifier": "web"}
+              host and shared_secret default to the authentication server
         '''
-    def __init__(self, host:str, shared_secret:str, port=1812, user_table=None, logger=logging, retries=DEFAULT_RETRIES, timeout=DEFAULT_TIMEOUT):
-        super().__init__(logger=logger)
-        self._inherit_info_str = f'{host}:{port}'
-        self._logger.info(f"{self.info_str}: Connecting to RADIUS Server")
-        self.radius = Radius(secret=shared_secret, host=host, port=port, retries=retries, timeout=timeout)
-        self.user_table = user_table if user_table is not None else []
+    def __init__(self, host:str|None=None, shared_secret:str|None=None, port=1812, user_table=None, logger=logging, retries=DEFAULT_RETRIES,
+                 timeout=DEFAULT_TIMEOUT, persistent=True, servers:list|None=None, balance=ROUND_ROBIN, max_failures=DEFAULT_MAX_FAILURES,
+                 eject_time=DEFAULT_EJECT_TIME, probe_interval=DEFAULT_PROBE_INTERVAL, adaptive_timeout=True, min_timeout=DEFAULT_MIN_TIMEOUT,
+                 deadline=None, auth_cache:dict|None=None, roles:dict|None=None, accounting:dict|None=None, user_table_file:str|None=None,
+                 user_table_check_interval=DEFAULT_USER_TABLE_CHECK_INTERVAL, user_cache:dict|bool|None=True, login_throttle:dict|None=None):
+        super().__init__(logger=logger, user_cache=user_cache if isinstance(user_cache, dict) else ({} if user_cache else None),
+                         login_throttle=login_throttle)
+        if servers:
+            self._inherit_info_str = ','.join(f"{server['host']}:{server.get('port', 1812)}" for server in servers)
+            self._logger.info(f"{self.info_str}: Connecting to RADIUS Servers")
+            self.radius = RadiusPool([Radius(secret=server.get('shared_secret', shared_secret), host=server['host'], port=server.get('port', 1812),
+                                             retries=1, timeout=timeout, persistent=persistent, adaptive=adaptive_timeout, min_timeout=min_timeout)
+                                      for server in servers],
+                                     retries=retries, balance=balance, max_failures=max_failures, eject_time=eject_time, probe_interval=probe_interval,
+                                     deadline=deadline)
+        elif host is not None and shared_secret is not None:
+            self._inherit_info_str = f'{host}:{port}'
+            self._logger.info(f"{self.info_str}: Connecting to RADIUS Server")
+            self.radius = Radius(secret=shared_secret, host=host, port=port, retries=retries, timeout=timeout, persistent=persistent,
+                                 adaptive=adaptive_timeout, min_timeout=min_timeout, deadline=deadline)
+        else:
+            raise ValueError("RADIUS configuration requires 'host' and 'shared_secret', or a list of 'servers'")
+        self._user_table = frozenset(user_table) if user_table is not None else frozenset()
+        self._user_table_lock = Lock()
+        self.user_table_file = user_table_file
+        self.user_table_check_interval = user_table_check_interval
+        self._user_table_mtime = None
+        self._user_table_checked = 0
+        self._disabled = set()
+        if user_table_file is not None:
+            self.reload_user_table()
+
+        # authentication result cache
+        self._auth_cache_config = auth_cache if isinstance(auth_cache, dict) else ({} if auth_cache else None)
+        self._auth_cache = None
+        if self._auth_cache_config is not None:
+            self._auth_cache = LRUCache(max_entries=self._auth_cache_config.get('max_entries', DEFAULT_AUTH_CACHE_ENTRIES))
+        self._auth_cache_salt = os.urandom(16)
+
+        # concurrent identical authentications (double clicks, client retries) share one RADIUS request
+        self._auth_flights = SingleFlight(waiter=lambda event: cooperative(event.wait))
+
+        # roles from the reply attributes of the last login of each user
+        self._roles_config = roles if roles is not None else {}
+        self._role_attributes = self._roles_config.get('attributes', DEFAULT_ROLE_ATTRIBUTES)
+        self._role_map = {key: frozenset([value] if isinstance(value, str) else value) for key, value in self._roles_config['map'].items()} \
+            if self._roles_config.get('map', None) is not None else None
+        self._roles = LRUCache(max_entries=self._roles_config.get('max_entries', DEFAULT_AUTH_CACHE_ENTRIES),
+                               ttl=self._roles_config.get('ttl', DEFAULT_ROLE_TTL))
+
+        # web session accounting
+        self.accounting = None
+        if accounting is not None:
+            accounting = dict(accounting)
+            self.accounting = RadiusAccounting(secret=accounting.pop('shared_secret', shared_secret if shared_secret is not None else servers[0].get('shared_secret')),
+                                               host=accounting.pop('host', host if host is not None else servers[0]['host']),
+                                               port=accounting.pop('port', DEFAULT_ACCT_PORT), timeout=accounting.pop('timeout', timeout),
+                                               persistent=persistent, **accounting)
+
+    def close(self):
+        ''' Stop the RADIUS pool health probes and flush the accounting queue '''
+        if isinstance(getattr(self, 'radius', None), RadiusPool):
+            self.radius.close()
+        if getattr(self, 'accounting', None) is not None:
+            self.accounting.close()
+            self.accounting = None
+
+    def session_started(self, user_id):
+        ''' Queue an Accounting Start for the web session.  The accounting session id is kept in the web session for session_ended '''
+        if self.accounting is not None:
+            session_id = self.accounting.start(user_id)
+            if has_request_context():
+                session[SESSION_ACCT_KEY] = {'id': session_id, 'user': user_id, 'started': time()}
+
+    def session_ended(self, user_id):
+        ''' Queue an Accounting Stop for the accounting session of this web session (the user's other web sessions stay open)
+            and drop the roles from the web session '''
+        if not has_request_context():
+            return
+        session.pop(SESSION_ROLES_KEY, None)
+        stored = session.pop(SESSION_ACCT_KEY, None)
+        if self.accounting is not None and isinstance(stored, dict) and stored.get('user', None) == user_id:
+            # the web session may have been started by another worker, pass the user and start time for the Stop record
+            self.accounting.stop(stored['id'], username=user_id, started=stored.get('started', time()))
 
     def authenticate_user(self, username:str, password=None, password_hash=None, strip_username=True, lcase_username=True):
         ''' Authenticate a user and return a FlaskUser object '''
         if strip_username:
             username = username.strip() # Remove spaces that might be before or after the username
         if lcase_username:
-            username = username.lcase() # Easier for mobile devices that might capitalize the first letter
-        if len(self.user_table) == 0 or username in self.user_table:
-            if self.radius.authenticate(username=username, password=password):
+            username = username.lower() # Easier for mobile devices that might capitalize the first letter
+        self.throttle_login(username)
+        if self.user_permitted(username):
+            cache_key = self._credential_key(username, password)
+            result = self._auth_cache.get(cache_key, None) if self._auth_cache is not None and cache_key is not None else None
+            if result is None:
+                if cache_key is not None:
+                    result = self._auth_flights.do(cache_key, self._radius_authenticate, username, password, cache_key)
+                else:
+                    result = self._radius_authenticate(username, password)
+            else:
+                self._logger.debug(f"{self.info_str}: {username}: Using cached auth result")
+            if result is not False:
                 self._logger.info(f"{self.info_str}: {username}: Auth Successful")
-                return FlaskUser(user_id=username, username=username, auth_ok=True, acct_active=True)
+                self.login_result(username, True)
+                self._roles.set(username, result)
+                self._store_session_roles(username, result)
+                self.invalidate_user(username)
+                return FlaskUser(user_id=username, username=username, auth_ok=True, acct_active=True, roles=result)
+        self.login_result(username, False)
         return None
 
-    def authorize_user(self, username: str, **kwargs):
-        ''' Need to setup the radius package to return extended attributes to use authorization '''
+    def _radius_authenticate(self, username:str, password, cache_key:tuple|None=None) -> frozenset|bool:
+        ''' Authenticate against the RADIUS server(s) and cache the result.  Returns the roles of the user, or False if rejected '''
+        # cooperative: does not block the gevent hub while waiting on the RADIUS server
+        attributes = self.radius.authenticate_attributes_cooperative(username=username, password=password)
+        result = self.map_roles(attributes) if attributes is not None else False
+        if self._auth_cache is not None and cache_key is not None:
+            self._auth_cache.set(cache_key, result, ttl=self._auth_cache_config.get('ttl' if result is not False else 'negative_ttl',
+                                                                                    DEFAULT_AUTH_CACHE_TTL if result is not False else DEFAULT_AUTH_CACHE_NEGATIVE_TTL))
+        return result
+
+    def map_roles(self, attributes) -> frozenset:
+        ''' Return the roles for the reply attributes of an Access-Accept '''
+        roles = set(self._roles_config.get('default', []))
+        for name in self._role_attributes:
+            for value in attributes.get(name, []):
+                for text in _attribute_strings(name, value):
+                    if self._role_map is None:
+                        roles.add(text)
+                    else:
+                        roles.update(self._role_map.get(f"{name}:{text}", ()))
+                        roles.update(self._role_map.get(text, ()))
+        return frozenset(roles)
+
+    def user_roles(self, username:str) -> frozenset|None:
+        ''' Return the roles of a logged in user, None if the user has not logged in within the role ttl '''
+        roles = self._roles.get(username, None, count=False)
+        return roles if roles is not None else self._session_roles(username)
+
+    def _store_session_roles(self, username:str, roles:frozenset):
+        ''' Save the roles and their expiry in the web session so any worker can use them '''
+        if has_request_context():
+            session[SESSION_ROLES_KEY] = {'user': username, 'roles': sorted(roles),
+                                          'expires': time() + self._roles_config.get('ttl', DEFAULT_ROLE_TTL)}
+
+    def _session_roles(self, username:str) -> frozenset|None:
+        ''' Return the unexpired roles of the user from the web session (and add them to the per process cache) '''
+        if not has_request_context():
+            return None
+        stored = session.get(SESSION_ROLES_KEY, None)
+        if not isinstance(stored, dict) or stored.get('user', None) != username:
+            return None
+        remaining = stored.get('expires', 0) - time()
+        if remaining <= 0:
+            return None
+        roles = frozenset(stored.get('roles', []))
+        self._roles.set(username, roles, ttl=remaining)
+        return roles
+
+    def _credential_key(self, username:str, password) -> tuple|None:
+        ''' Return the key identifying a username and password for the auth cache and request coalescing.
+            A salted PBKDF2 digest if the auth cache is enabled, otherwise a salted SHA-256 (the key only lives while the request is in flight).
+            PBKDF2 is offloaded so it does not block the gevent hub '''
+        if password is None:
+            return None
+        password = password.encode('utf-8') if isinstance(password, str) else password
+        salt = self._auth_cache_salt + username.encode('utf-8')
+        if self._auth_cache is None:
+            return (username, hashlib.sha256(salt + password).digest())
+        return (username, offload(hashlib.pbkdf2_hmac, 'sha256', password, salt, self._auth_cache_config.get('iterations', DEFAULT_AUTH_CACHE_ITERATIONS)))
+
+    @property
+    def user_table(self) -> frozenset:
+        ''' Returns the permitted user ids (empty if all users are permitted) '''
+        if self.user_table_file is not None and monotonic() - self._user_table_checked >= self.user_table_check_interval:
+            self._check_user_table()
+        return self._user_table
+
+    @user_table.setter
+    def user_table(self, user_table):
+        self._user_table = frozenset(user_table) if user_table is not None else frozenset()
+        self.invalidate_user()
+
+    def user_permitted(self, user_id) -> bool:
+        ''' Returns True if the user is in the user table (or there is no user table) and is not disabled '''
+        user_table = self.user_table
+        return (len(user_table) == 0 or user_id in user_table) and user_id not in self._disabled
+
+    def reload_user_table(self) -> bool:
+        ''' Read the user table file.  Returns False (and keeps the current table) if the file can not be read '''
+        try:
+            mtime = os.stat(self.user_table_file).st_mtime_ns
+            with open(self.user_table_file, 'r', encoding='utf-8') as input_file:
+                data = input_file.read()
+        except OSError as e:
+            self._logger.error(f"{self.info_str}: Unable to read user table {self.user_table_file}: {e}")
+            return False
+        try:
+            users = json.loads(data) if data.lstrip().startswith('[') else \
+                [line.strip() for line in data.splitlines() if line.strip() and not line.strip().startswith('#')]
+        except ValueError as e:
+            self._logger.error(f"{self.info_str}: Invalid user table {self.user_table_file}: {e}")
+            return False
+        with self._user_table_lock:
+            self._user_table_mtime = mtime
+            self._user_table_checked = monotonic()
+            self.user_table = users
+        self._logger.info(f"{self.info_str}: Loaded {len(self._user_table)} users from {self.user_table_file}")
+        return True
+
+    def _check_user_table(self):
+        ''' Reload the user table if the file has changed '''
+        with self._user_table_lock:
+            if monotonic() - self._user_table_checked < self.user_table_check_interval:
+                return
+            self._user_table_checked = monotonic()
+            try:
+                changed = os.stat(self.user_table_file).st_mtime_ns != self._user_table_mtime
+            except OSError:
+                changed = False
+        if changed:
+            self.reload_user_table()
+
+    def enable_user(self, user_id):
+        ''' Remove a local block on a user '''
+        self._disabled.discard(user_id)
+        self.invalidate_user(user_id)
+        return True
+
+    def disable_user(self, user_id):
+        ''' Block a user locally, logins are rejected and existing sessions are dropped '''
+        self._disabled.add(user_id)
+        self.invalidate_credentials(user_id)
+        return True
+
+    def update_user(self, user_id, username=None, password=None, enabled=None, **kwargs):
+        ''' Only the local enabled state can be changed, other properties are held by the RADIUS server '''
+        if enabled is not None:
+            return self.enable_user(user_id) if enabled else self.disable_user(user_id)
+        self.invalidate_user(user_id)
         return NotImplemented
 
-    def get_user(self, user_id=None):
-        ''' Find a user from a user_id - Currently requires the user list '''
+    def invalidate_credentials(self, username:str|None=None) -> int:
+        ''' Remove cached authentication results, roles and users for a user, or for all users.  Returns the number of entries removed '''
+        self._roles.invalidate(lambda key: username is None or key == username)
+        self.invalidate_user(username)
+        if self._auth_cache is None:
+            return 0
+        return self._auth_cache.invalidate(lambda key: username is None or key[0] == username)
+
+    def authorize_user(self, username:str, roles=None, **kwargs) -> bool:
+        ''' Authorize a user from the roles returned by the RADIUS server at login.
+            Returns True if the user has logged in within the role ttl and has any of the roles (or roles is None) '''
+        user_roles = self.user_roles(username)
+        if user_roles is None:
+            return False
+        return roles is None or not user_roles.isdisjoint([roles] if isinstance(roles, str) else roles)
+
+    def get_user(self, user_id=None, username=None):
+        ''' Find a user from a user_id - The user of the current Flask-Login session (or a user that logged in to this process within
+            the role ttl) is authenticated, otherwise requires the user list '''
+        user_id = user_id if user_id is not None else username
+        if user_id in self._disabled:
+            return None
+        roles = self.user_roles(user_id)
+        logged_in = roles is not None or (has_request_context() and session.get('_user_id', None) == user_id)
+        if logged_in and self.user_permitted(user_id):
+            return FlaskUser(user_id, user_id, True, True, roles=roles if roles is not None else self._roles_config.get('default', []))
         if user_id in self.user_table:
             return FlaskUser(user_id, user_id, False, False)
         return None
+
+
+def _attribute_strings(name:str, value:bytes) -> list:
+    ''' Return the text values of a reply attribute used for role mapping '''
+    if name.lower() == 'vendor-specific':
+        values = [data for _, _, data in vendor_attributes(value)]
+    elif name.lower() == 'tunnel-private-group-id' and value and value[0] <= 0x1f:
+        # strip the tag (RFC 2868 3.6)
+        values = [value[1:]]
+    else:
+        values = [value]
+    return [value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value) for value in values]
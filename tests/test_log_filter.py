@@ -0,0 +1,48 @@
+'''
+Web log filter (see FlaskLogFilter)
+'''
+
+import logging
+import pytest
+from flask_app_class.flask_app import FlaskLogFilter
+
+
+def record(message:str) -> logging.LogRecord:
+    return logging.LogRecord('werkzeug', logging.INFO, __file__, 0, message, None, None)
+
+
+def test_filter_entries():
+    log_filter = FlaskLogFilter(['HEAD /healthz', 're:^GET /api/v[0-9]+/status', {'pattern': '/poll', 'sample': 2}])
+    assert log_filter.filter(record('"HEAD /healthz HTTP/1.1" 200')) is False
+    assert log_filter.filter(record('GET /api/v2/status')) is False
+    assert log_filter.filter(record('GET /index.html')) is True
+    assert [log_filter.filter(record('GET /poll')) for _ in range(4)] == [True, False, True, False]
+    assert log_filter.stats['/poll'] == {'matched': 4, 'dropped': 2}
+
+
+def test_assigning_list_recompiles():
+    log_filter = FlaskLogFilter(['/healthz'])
+    log_filter.log_filter_list = ['/metrics']
+    assert log_filter.filter(record('GET /healthz')) is True
+    assert log_filter.filter(record('GET /metrics')) is False
+    assert list(log_filter.stats) == ['/metrics']
+
+
+def test_in_place_changes_need_recompile():
+    entry = {'pattern': '/poll'}
+    log_filter = FlaskLogFilter([entry])
+    entry['sample'] = 2
+    log_filter.log_filter_list.append('/healthz')
+    assert log_filter.filter(record('GET /healthz')) is True
+
+    log_filter.recompile()
+    assert log_filter.filter(record('GET /healthz')) is False
+    assert [log_filter.filter(record('GET /poll')) for _ in range(2)] == [True, False]
+
+
+def test_invalid_list_keeps_previous():
+    log_filter = FlaskLogFilter(['/healthz'])
+    with pytest.raises(ValueError):
+        log_filter.log_filter_list = ['re:(']
+    assert log_filter.log_filter_list == ['/healthz']
+    assert log_filter.filter(record('GET /healthz')) is False
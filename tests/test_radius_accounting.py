@@ -0,0 +1,76 @@
+'''
+RADIUS accounting for web sessions (see RadiusUserController.session_started / session_ended)
+'''
+
+import json
+import logging
+import pytest
+from time import sleep, monotonic
+from flask import request
+from flask_login import login_user, logout_user
+from flask_app_class import FlaskApp
+from flask_app_class.radius_loadtest import RadiusTestServer
+
+SECRET = 'accttest'
+ACCT_STATUS_START, ACCT_STATUS_STOP = 1, 2
+
+
+class AccountingApp(FlaskApp):
+    def web_login(self):
+        login_user(self.user_controller.authenticate_user(request.args['user'], 'password'))
+        return 'ok'
+
+    def web_logout(self):
+        logout_user()
+        return 'ok'
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'templates').mkdir()
+    logging.disable(logging.WARNING)
+    server = RadiusTestServer(secret=SECRET)
+    server.start()
+    config = {'auth': 'radius', 'radius': {'host': server.host, 'port': server.port, 'shared_secret': SECRET,
+                                           'accounting': {'port': server.port}},
+              'web_pages': {'web_login': {'routes': ['/login']}, 'web_logout': {'routes': ['/logout']}}}
+    (tmp_path / 'config.json').write_text(json.dumps(config))
+    app = AccountingApp(config_file=str(tmp_path / 'config.json'), templates_path=str(tmp_path / 'templates'))
+    app.radius_server = server
+    yield app
+    app.stop()
+    server.stop()
+    logging.disable(logging.NOTSET)
+
+
+def wait_records(server, count:int, timeout:float=5) -> list:
+    ''' Wait for the accounting records sent from the background queue, returns (status, session id) of each '''
+    end = monotonic() + timeout
+    while len(server.accounting_records) < count and monotonic() < end:
+        sleep(0.01)
+    return [(int.from_bytes(record['Acct-Status-Type'][0], 'big'), record['Acct-Session-Id'][0].decode()) for record in server.accounting_records]
+
+
+def test_logout_stops_only_its_session(app):
+    first, second = app.app.test_client(), app.app.test_client()
+    first.get('/login?user=alice')
+    second.get('/login?user=alice')
+    starts = [session_id for status, session_id in wait_records(app.radius_server, 2) if status == ACCT_STATUS_START]
+    assert len(starts) == 2
+
+    first.get('/logout')
+    records = wait_records(app.radius_server, 3)
+    assert [session_id for status, session_id in records if status == ACCT_STATUS_STOP] == [starts[0]]
+    assert app.user_controller.accounting.user_sessions('alice') == [starts[1]]
+
+
+def test_logout_on_another_worker_sends_stop(app):
+    client = app.app.test_client()
+    client.get('/login?user=alice')
+    (status, session_id), = wait_records(app.radius_server, 1)
+    # the session was opened by another process, this one has no record of it
+    app.user_controller.accounting.sessions.clear()
+
+    client.get('/logout')
+    assert wait_records(app.radius_server, 2)[1] == (ACCT_STATUS_STOP, session_id)
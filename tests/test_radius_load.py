@@ -0,0 +1,36 @@
+'''
+Load benchmark of the RADIUS client against the local RadiusTestServer (see flask_app_class.radius_loadtest)
+'''
+
+import logging
+import pytest
+from flask_app_class._radius import Radius
+from flask_app_class.radius_loadtest import RadiusTestServer, run_load, ACCEPT
+
+SECRET = 'loadtest'
+P99_BOUND = 2.0
+
+
+@pytest.fixture
+def server():
+    with RadiusTestServer(secret=SECRET, latency=0.002, jitter=0.001, drop=0.02, seed=1) as server:
+        yield server
+
+
+@pytest.mark.parametrize('concurrency', [32, 300])
+def test_radius_load(server, caplog, record_property, concurrency):
+    ''' Every request completes (lost packets are retransmitted) and Identifiers are not exhausted, including with more concurrent
+        requests than the 256 Identifiers of a transport '''
+    radius = Radius(SECRET, host=server.host, port=server.port, retries=5, timeout=0.5)
+    with caplog.at_level(logging.ERROR):
+        result = run_load(radius.authenticate, requests=600, concurrency=concurrency)
+    # reported in the junit xml (--junitxml) rather than printed
+    for name, value in result.summary().items():
+        record_property(name, value)
+
+    assert result.requests == 600, str(result)
+    assert result.outcomes == {ACCEPT: 600}, str(result)
+    assert result.percentile(99) < P99_BOUND, str(result)
+    assert result.throughput > 0
+    assert server.counters['dropped'] > 0
+    assert not [record for record in caplog.records if 'No free identifiers' in record.getMessage()]
@@ -0,0 +1,97 @@
+'''
+Page response cache with logged in users (see FlaskApp._cached_page_response)
+'''
+
+import json
+import logging
+import pytest
+from flask import request
+from flask_login import login_user, current_user
+from flask_app_class import FlaskApp
+from flask_app_class.radius_loadtest import RadiusTestServer
+
+SECRET = 'cachetest'
+
+
+class CacheApp(FlaskApp):
+    def web_login(self):
+        login_user(self.user_controller.authenticate_user(request.args['user'], 'password'))
+        return 'ok'
+
+    def web_profile(self):
+        return f"hello {current_user.username if current_user.is_authenticated else 'anonymous'}"
+
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    ''' Returns a function building a CacheApp (RADIUS users accepted by a local test server) with the given page configs '''
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'templates').mkdir()
+    logging.disable(logging.WARNING)
+    server = RadiusTestServer(secret=SECRET, accept_attributes={'Class': b'staff'})
+    server.start()
+    apps = []
+
+    def make_app(web_pages:dict) -> CacheApp:
+        config = {'auth': 'radius', 'radius': {'host': server.host, 'port': server.port, 'shared_secret': SECRET},
+                  'web_pages': dict({'web_login': {'routes': ['/login']}}, **web_pages)}
+        (tmp_path / 'config.json').write_text(json.dumps(config))
+        apps.append(CacheApp(config_file=str(tmp_path / 'config.json'), templates_path=str(tmp_path / 'templates')))
+        return apps[-1]
+
+    yield make_app
+    for app in apps:
+        app.stop()
+    server.stop()
+    logging.disable(logging.NOTSET)
+
+
+def test_logged_in_users_bypass_cache(make_app):
+    ''' Without vary_user a page showing current_user must not be served to another user from the cache '''
+    app = make_app({'web_profile': {'routes': ['/profile'], 'cache': {'ttl': 60}}})
+    alice, bob = app.app.test_client(), app.app.test_client()
+    alice.get('/login?user=alice')
+    bob.get('/login?user=bob')
+
+    assert alice.get('/profile').text == 'hello alice'
+    assert bob.get('/profile').text == 'hello bob'
+    assert app.cache_stats['pages'].get('web_profile', {}).get('hits', 0) == 0
+
+
+def test_role_page_cache_requires_vary_user(make_app):
+    with pytest.raises(ValueError):
+        make_app({'web_profile': {'routes': ['/profile'], 'roles': ['staff'], 'cache': {'ttl': 60}}})
+
+
+def test_role_page_not_shared_between_users(make_app):
+    app = make_app({'web_profile': {'routes': ['/profile'], 'roles': ['staff'], 'cache': {'ttl': 60, 'vary_user': True}}})
+    alice, bob = app.app.test_client(), app.app.test_client()
+    alice.get('/login?user=alice')
+    bob.get('/login?user=bob')
+
+    for _ in range(2):
+        assert alice.get('/profile').text == 'hello alice'
+        assert bob.get('/profile').text == 'hello bob'
+    assert app.cache_stats['pages']['web_profile'] == {'hits': 2, 'misses': 2}
+
+
+def test_anonymous_requests_are_cached(make_app):
+    app = make_app({'web_profile': {'routes': ['/profile'], 'cache': {'ttl': 60}}})
+    client = app.app.test_client()
+
+    assert client.get('/profile').text == 'hello anonymous'
+    assert client.get('/profile').text == 'hello anonymous'
+    assert app.cache_stats['pages']['web_profile'] == {'hits': 1, 'misses': 1}
+
+
+def test_vary_user_caches_per_user(make_app):
+    app = make_app({'web_profile': {'routes': ['/profile'], 'cache': {'ttl': 60, 'vary_user': True}}})
+    alice, bob = app.app.test_client(), app.app.test_client()
+    alice.get('/login?user=alice')
+    bob.get('/login?user=bob')
+
+    for _ in range(2):
+        assert alice.get('/profile').text == 'hello alice'
+        assert bob.get('/profile').text == 'hello bob'
+    assert app.cache_stats['pages']['web_profile'] == {'hits': 2, 'misses': 2}
+    assert 'Cookie' in alice.get('/profile').headers['Vary']
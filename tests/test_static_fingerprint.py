@@ -0,0 +1,63 @@
+'''
+Fingerprinted static routes for files edited without the static watcher (see FlaskApp._static_fingerprint_current)
+'''
+
+import os
+import json
+import logging
+import pytest
+from flask_app_class import FlaskApp
+from flask_app_class.flask_app import STATIC_FINGERPRINT_CACHE_CONTROL
+
+
+@pytest.fixture(params=['static_cache', 'send_file'])
+def app(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'templates').mkdir()
+    (tmp_path / 'static').mkdir()
+    (tmp_path / 'static' / 'app.js').write_text('var version = 1;')
+    logging.disable(logging.WARNING)
+    config = {'static_fingerprint': True, 'static_cache': {'check_interval': 0} if request.param == 'static_cache' else False}
+    (tmp_path / 'config.json').write_text(json.dumps(config))
+    app = FlaskApp(config_file=str(tmp_path / 'config.json'), templates_path=str(tmp_path / 'templates'))
+    app.static_file = tmp_path / 'static' / 'app.js'
+    yield app
+    app.stop()
+    logging.disable(logging.NOTSET)
+
+
+def touch(path, content:str|None=None):
+    ''' Rewrite a file (or only update its mtime) with a mtime that differs from the previous one '''
+    mtime_ns = os.stat(path).st_mtime_ns + 1_000_000_000
+    if content is not None:
+        path.write_text(content)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_fingerprint_served_immutable(app):
+    route = app.static_url('/app.js')
+    assert route != '/app.js'
+    response = app.app.test_client().get(route)
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == STATIC_FINGERPRINT_CACHE_CONTROL
+
+
+def test_edited_file_not_served_under_old_fingerprint(app):
+    route = app.static_url('/app.js')
+    touch(app.static_file, 'var version = 2;')
+
+    response = app.app.test_client().get(route + '?download=1')
+    assert response.status_code == 302
+    assert response.headers['Location'] == '/app.js?download=1'
+    assert app.static_url('/app.js') == '/app.js'
+    response = app.app.test_client().get('/app.js')
+    assert response.text == 'var version = 2;'
+    assert response.headers.get('Cache-Control', None) != STATIC_FINGERPRINT_CACHE_CONTROL
+
+
+def test_touched_file_keeps_fingerprint(app):
+    route = app.static_url('/app.js')
+    touch(app.static_file)
+
+    assert app.app.test_client().get(route).status_code == 200
+    assert app.static_url('/app.js') == route
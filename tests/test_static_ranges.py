@@ -0,0 +1,66 @@
+'''
+Byte range requests for static files held in the static cache and streamed from disk (see static_cache.send_static_entry)
+'''
+
+import json
+import logging
+import pytest
+from flask_app_class import FlaskApp
+
+DATA = bytes(range(100))
+
+
+@pytest.fixture(params=['memory', 'disk'])
+def client(request, tmp_path, monkeypatch):
+    ''' Test client serving /data.bin (100 bytes) from memory or from disk (cache file size threshold below the file size) '''
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'templates').mkdir()
+    (tmp_path / 'static').mkdir()
+    (tmp_path / 'static' / 'data.bin').write_bytes(DATA)
+    logging.disable(logging.WARNING)
+    config = {'static_cache': {'max_file_size': 1024 if request.param == 'memory' else 10}}
+    (tmp_path / 'config.json').write_text(json.dumps(config))
+    app = FlaskApp(config_file=str(tmp_path / 'config.json'), templates_path=str(tmp_path / 'templates'))
+    assert (app.static_cache.lookup(app.static_pages['/data.bin']).data is not None) == (request.param == 'memory')
+    yield app.app.test_client()
+    app.stop()
+    logging.disable(logging.NOTSET)
+
+
+def test_full_response(client):
+    response = client.get('/data.bin')
+    assert response.status_code == 200
+    assert response.data == DATA
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+
+def test_single_range(client):
+    response = client.get('/data.bin', headers={'Range': 'bytes=0-4'})
+    assert response.status_code == 206
+    assert response.data == DATA[0:5]
+    assert response.headers['Content-Range'] == 'bytes 0-4/100'
+    assert response.content_length == 5
+
+
+def test_multiple_ranges(client):
+    response = client.get('/data.bin', headers={'Range': 'bytes=0-4,10-14'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    boundary = response.mimetype_params['boundary'].encode()
+    assert response.content_length == len(response.data)
+    parts = response.data.split(b'--' + boundary)
+    assert parts[-1] == b'--\r\n'
+    assert [part.split(b'\r\n\r\n', 1)[1][:-2] for part in parts[1:-1]] == [DATA[0:5], DATA[10:15]]
+    assert b'Content-Range: bytes 10-14/100' in parts[2]
+
+
+def test_unsatisfiable_range(client):
+    response = client.get('/data.bin', headers={'Range': 'bytes=200-300'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */100'
+
+
+def test_if_range_mismatch_returns_full_file(client):
+    response = client.get('/data.bin', headers={'Range': 'bytes=0-4', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == DATA